@@ -0,0 +1,27 @@
+"""Add chapterFile parts
+
+Revision ID: 4e1f9c2a7b3d
+Revises: 71bd610aaa43
+Create Date: 2026-10-18 17:30:12.402311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = '4e1f9c2a7b3d'
+down_revision = '71bd610aaa43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('chapterfile', sa.Column('file_parts', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('chapterfile', sa.Column('cbz_parts', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('chapterfile') as batch_op:
+        batch_op.drop_column('cbz_parts')
+        batch_op.drop_column('file_parts')
@@ -0,0 +1,36 @@
+"""Add queuedChapter
+
+Revision ID: 9c3b7e5d2f10
+Revises: 4e1f9c2a7b3d
+Create Date: 2026-10-18 19:05:41.118245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = '9c3b7e5d2f10'
+down_revision = '4e1f9c2a7b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('queuedchapter',
+                    sa.Column('id', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+                    sa.Column('user_id', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+                    sa.Column('lane', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+                    sa.Column('client', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+                    sa.Column('chapter', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+                    sa.Column('created', sa.Float(), nullable=False),
+                    sa.Column('leased_until', sa.Float(), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_queuedchapter_user_id'), 'queuedchapter', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_queuedchapter_user_id'), table_name='queuedchapter')
+    op.drop_table('queuedchapter')
@@ -0,0 +1,27 @@
+"""Add chapterFile unique parts
+
+Revision ID: b81f4d6a3c27
+Revises: 9c3b7e5d2f10
+Create Date: 2026-10-18 18:12:37.540918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = 'b81f4d6a3c27'
+down_revision = '9c3b7e5d2f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('chapterfile', sa.Column('file_unique_parts', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+    op.add_column('chapterfile', sa.Column('cbz_unique_parts', sqlmodel.sql.sqltypes.AutoString(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('chapterfile') as batch_op:
+        batch_op.drop_column('cbz_unique_parts')
+        batch_op.drop_column('file_unique_parts')
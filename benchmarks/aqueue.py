@@ -0,0 +1,77 @@
+"""
+Measures tools.aqueue.AQueue with a burst of queued items, like the one the manga updater makes when a popular
+chapter is released to many subscribers: how fast items are put, how fast workers drain them, and how evenly users
+are served.
+
+    python benchmarks/aqueue.py
+    python benchmarks/aqueue.py --items 1000 10000 100000 --users 1 100 10000 --workers 10
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tools.aqueue import AQueue  # noqa: E402
+
+
+async def measure(items: int, users: int, workers: int) -> dict:
+    queue = AQueue()
+    start = time.perf_counter()
+    for i in range(items):
+        await queue.put(i, i % users)
+    put_seconds = time.perf_counter() - start
+
+    # Locks in the order their items were given
+    served = []
+    drained = asyncio.Event()
+
+    async def worker(worker_id: int):
+        while True:
+            item, lock = await queue.get(worker_id)
+            served.append(lock)
+            # Lets the other workers run while the lock is held, like a job does
+            await asyncio.sleep(0)
+            queue.release(lock)
+            if len(served) == items:
+                drained.set()
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(worker(i)) for i in range(workers)]
+    await drained.wait()
+    drain_seconds = time.perf_counter() - start
+    for task in tasks:
+        task.cancel()
+    assert len(served) == items
+
+    # With round-robin, a user with n items gets its last one after about n rounds of all the users
+    last = {lock: position for position, lock in enumerate(served)}
+    ideal = {lock: (items - 1 - lock) // users * users + lock for lock in last}
+    return {
+        'items': items,
+        'users': users,
+        'workers': workers,
+        'put_seconds': round(put_seconds, 4),
+        'puts_per_second': round(items / put_seconds),
+        'drain_seconds': round(drain_seconds, 4),
+        'gets_per_second': round(items / drain_seconds),
+        'max_fairness_lag': max(abs(last[lock] - ideal[lock]) for lock in last),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', nargs='+', type=int, default=[100_000])
+    parser.add_argument('--users', nargs='+', type=int, default=[1, 100, 10_000])
+    parser.add_argument('--workers', type=int, default=10, help='workers getting items, like the chapter workers of the bot')
+    args = parser.parse_args()
+
+    results = [asyncio.run(measure(items, users, args.workers)) for items in args.items for users in args.users]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
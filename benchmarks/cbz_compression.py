@@ -0,0 +1,59 @@
+"""
+Measures, for each picture format found in the given folders, how many bytes deflating the pictures of a cbz
+saves and how much CPU it costs, to choose the compression policy of img2cbz.core.COMPRESSION.
+
+    python benchmarks/cbz_compression.py cache/<plugin>/<manga>/<chapter> ...
+"""
+import argparse
+import json
+import sys
+import time
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from img2cbz.core import compress_type  # noqa: E402
+
+
+def measure(files, level):
+    formats = defaultdict(lambda: {'files': 0, 'bytes': 0, 'deflated_bytes': 0, 'cpu_seconds': 0.0})
+    for file in files:
+        data = file.read_bytes()
+        start = time.process_time()
+        # Same settings zipfile uses for ZIP_DEFLATED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = len(compressor.compress(data)) + len(compressor.flush())
+        cpu = time.process_time() - start
+        result = formats[file.suffix.lower()]
+        result['files'] += 1
+        result['bytes'] += len(data)
+        result['deflated_bytes'] += deflated
+        result['cpu_seconds'] += cpu
+    for suffix, result in formats.items():
+        saved = result['bytes'] - result['deflated_bytes']
+        result['saved_bytes'] = saved
+        result['saved_percent'] = round(100 * saved / result['bytes'], 3) if result['bytes'] else 0
+        # Bytes saved per second of CPU spent deflating
+        result['saved_bytes_per_cpu_second'] = round(saved / result['cpu_seconds']) if result['cpu_seconds'] else 0
+        result['cpu_seconds'] = round(result['cpu_seconds'], 4)
+        result['current_policy'] = 'deflated' if compress_type(f'page{suffix}') else 'stored'
+    return dict(formats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folders', nargs='+', type=Path)
+    parser.add_argument('--level', type=int, default=zlib.Z_DEFAULT_COMPRESSION, help='zlib compression level')
+    args = parser.parse_args()
+
+    files = [file for folder in args.folders for file in sorted(folder.rglob('*'))
+             if file.is_file() and file.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')]
+    if not files:
+        parser.error('No pictures found')
+    print(json.dumps(measure(files, args.level), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Measures the throughput of the chapter builders (img2pdf, img2cbz, make_thumb and the single pass img2chapter) on
+synthetic chapters generated locally, so changes to them can be compared between releases.
+
+For every chapter kind and builder it reports pages per second, input MB per second, output size and peak RSS as
+JSON. Each run happens in a new process so the peak RSS of a builder doesn't include the others.
+
+    python benchmarks/pipeline.py --output results.json
+    python benchmarks/pipeline.py --kinds jpeg webtoon --builders img2pdf --repeat 5
+"""
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import PIL  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from img2cbz.core import img2cbz  # noqa: E402
+from img2pdf.core import img2chapter, img2pdf, make_thumb  # noqa: E402
+
+PAGE_WIDTH = 800
+PAGE_HEIGHT = 1200
+STRIP_HEIGHT = 8000
+
+
+def builder_img2pdf(files, out):
+    pdf = out / 'chapter.pdf'
+    img2pdf(files, pdf)
+    return [pdf]
+
+
+def builder_img2cbz(files, out):
+    cbz = out / 'chapter.cbz'
+    img2cbz(files, cbz)
+    return [cbz]
+
+
+def builder_make_thumb(files, out):
+    return [make_thumb(out, files)]
+
+
+def builder_img2chapter(files, out):
+    outputs, thumb = img2chapter(files, out, 'chapter')
+    return [path for parts in outputs.values() for path in parts] + [thumb]
+
+
+BUILDERS = {
+    'img2pdf': builder_img2pdf,
+    'img2cbz': builder_img2cbz,
+    'make_thumb': builder_make_thumb,
+    'img2chapter': builder_img2chapter,
+}
+
+
+def synthetic_page(rng: random.Random, width: int, height: int, mode: str) -> Image.Image:
+    """
+    A page looking enough like a scan to compress like one: a gradient background, panels and some noise.
+    """
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(height // 150):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + rng.randrange(50, width // 2), y + rng.randrange(50, 300)), fill=color,
+                       outline=(0, 0, 0), width=3)
+    # Low resolution noise scaled up, seeded so every run gets the same pictures
+    noise = Image.frombytes('L', (width // 8, height // 8), rng.randbytes(width // 8 * height // 8))
+    img = Image.blend(img, noise.resize((width, height)).convert('RGB'), 0.15)
+    if mode == 'RGBA':
+        img.putalpha(Image.linear_gradient('L').resize((width, height)))
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+
+def save_page(img: Image.Image, path: Path, fmt: str):
+    buffer = BytesIO()
+    img.save(buffer, format=fmt, **({'quality': 85} if fmt in ('JPEG', 'WEBP') else {}))
+    path.write_bytes(buffer.getvalue())
+
+
+# Chapter kind -> list of (format, mode, width, height) of its pages
+def chapter_pages(kind: str, pages: int):
+    if kind == 'jpeg':
+        return [('JPEG', 'RGB', PAGE_WIDTH, PAGE_HEIGHT)] * pages
+    if kind == 'png':
+        return [('PNG', 'RGB', PAGE_WIDTH, PAGE_HEIGHT)] * pages
+    if kind == 'webp':
+        return [('WEBP', 'RGB', PAGE_WIDTH, PAGE_HEIGHT)] * pages
+    if kind == 'webtoon':
+        # Few very tall strips, like most manhwa sites serve them
+        return [('JPEG', 'RGB', PAGE_WIDTH, STRIP_HEIGHT)] * max(1, pages * PAGE_HEIGHT // STRIP_HEIGHT)
+    if kind == 'mixed':
+        modes = [('JPEG', 'RGB'), ('JPEG', 'L'), ('JPEG', 'CMYK'), ('PNG', 'RGBA'), ('PNG', 'P'), ('WEBP', 'RGB')]
+        return [(*modes[i % len(modes)], PAGE_WIDTH, PAGE_HEIGHT) for i in range(pages)]
+    raise ValueError(f'Unknown chapter kind {kind}')
+
+
+KINDS = ['jpeg', 'png', 'webp', 'webtoon', 'mixed']
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+def generate_chapter(folder: Path, kind: str, pages: int, seed: int):
+    rng = random.Random(f'{seed}-{kind}')
+    folder.mkdir(parents=True)
+    for i, (fmt, mode, width, height) in enumerate(chapter_pages(kind, pages)):
+        save_page(synthetic_page(rng, width, height, mode), folder / f'{i:04}.{EXTENSIONS[fmt]}', fmt)
+
+
+def peak_rss() -> int:
+    """
+    Peak resident memory of this process in bytes.
+    """
+    try:
+        # ru_maxrss keeps the peak of the process before exec, i.e. of the benchmark parent, VmHWM doesn't
+        status = Path('/proc/self/status').read_text()
+        return int(next(line for line in status.splitlines() if line.startswith('VmHWM:')).split()[1]) * 1024
+    except (OSError, StopIteration):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def run_builder(builder: str, chapter: Path, out: Path) -> dict:
+    """
+    Runs in the benchmark subprocess.
+    """
+    files = sorted(file for file in chapter.iterdir() if file.is_file())
+    out.mkdir(parents=True, exist_ok=True)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    outputs = BUILDERS[builder](files, out)
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+    return {'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_bytes': peak_rss(),
+            'output_bytes': sum(Path(path).stat().st_size for path in outputs)}
+
+
+def measure(builder: str, chapter: Path, out: Path, repeat: int) -> dict:
+    runs = []
+    for i in range(repeat):
+        run_out = out / f'{builder}-{i}'
+        process = subprocess.run([sys.executable, __file__, '--run', builder, str(chapter), str(run_out)],
+                                 check=True, capture_output=True, text=True)
+        runs.append(json.loads(process.stdout.splitlines()[-1]))
+        shutil.rmtree(run_out, ignore_errors=True)
+
+    files = [file for file in chapter.iterdir() if file.is_file()]
+    input_bytes = sum(file.stat().st_size for file in files)
+    # The fastest run is the least disturbed by the rest of the machine
+    seconds = min(run['seconds'] for run in runs)
+    return {
+        'pages': len(files),
+        'input_bytes': input_bytes,
+        'output_bytes': runs[-1]['output_bytes'],
+        'seconds': round(seconds, 4),
+        'cpu_seconds': round(min(run['cpu_seconds'] for run in runs), 4),
+        'pages_per_second': round(len(files) / seconds, 2),
+        'mb_per_second': round(input_bytes / 1024 / 1024 / seconds, 2),
+        'peak_rss_bytes': max(run['peak_rss_bytes'] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--builders', nargs='+', choices=list(BUILDERS), default=list(BUILDERS))
+    parser.add_argument('--pages', type=int, default=40, help='pages of each chapter')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each builder, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='file to write the results to instead of stdout')
+    parser.add_argument('--run', nargs=3, metavar=('BUILDER', 'CHAPTER', 'OUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        builder, chapter, out = args.run
+        print(json.dumps(run_builder(builder, Path(chapter), Path(out))))
+        return
+
+    results = {
+        'environment': {'python': platform.python_version(), 'pillow': PIL.__version__, 'platform': platform.platform(),
+                        'machine': platform.machine()},
+        'settings': {'pages': args.pages, 'repeat': args.repeat, 'seed': args.seed},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='pipeline-benchmark-') as tmp:
+        for kind in args.kinds:
+            chapter = Path(tmp) / kind
+            generate_chapter(chapter, kind, args.pages, args.seed)
+            results['results'][kind] = {builder: measure(builder, chapter, Path(tmp) / 'out', args.repeat)
+                                        for builder in args.builders}
+            print(f'{kind} done', file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,16 @@ import re
 from dataclasses import dataclass
 import datetime as dt
 import json
+import time
+from contextlib import aclosing, nullcontext
+from io import BytesIO
 
 import pyrogram.errors
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaDocument
 
 from config import env_vars, dbname
-from img2cbz.core import fld2cbz
-from img2pdf.core import fld2pdf, fld2thumb
+from img2pdf.core import ChapterBuilder, make_thumb, jpeg_passthrough, pdf_page, named_buffer
+from img2pdf.normalize import needs_normalizing, normalize_page
 from plugins import *
 import os
 
@@ -22,9 +25,18 @@ from loguru import logger
 
 from models.db import DB, ChapterFile, Subscription, LastChapter, MangaName, MangaOutput
 from pagination import Pagination
-from plugins.client import clean
-from tools.aqueue import AQueue
+from plugins.client import clean, SharedTransport
+from tools.aqueue import AQueue, Lane
+from tools.broadcast import Broadcast, broadcast_lock, fan_out, BLOCKED_ERRORS
+from tools.conversion import ConversionPool
+from tools.durable_queue import DurableQueue
 from tools.flood import retry_on_flood
+from tools.image_cache import ImageCache
+from tools.prefetch import Prefetcher
+from tools.ratelimit import RateLimiter
+from tools.singleflight import SingleFlight
+from tools.thumbnail_cache import ThumbnailCache
+from tools.worker_pool import WorkerPool
 
 mangas: Dict[str, MangaCard] = dict()
 chapters: Dict[str, MangaChapter] = dict()
@@ -37,6 +49,7 @@ language_query: Dict[str, Tuple[str, str]] = dict()
 users_in_channel: Dict[int, dt.datetime] = dict()
 locks: Dict[int, asyncio.Lock] = dict()
 all_search: Dict[str, str] = dict()
+chapter_pages: Dict[str, str] = dict()
 
 plugin_dicts: Dict[str, Dict[str, MangaClient]] = {
     "🇬🇧 EN": {
@@ -71,12 +84,36 @@ plugin_dicts: Dict[str, Dict[str, MangaClient]] = {
 }
 
 cache_dir = "cache"
+image_cache_dir = os.path.join(cache_dir, "images")
+# Chapter folders are only needed while a chapter is being built, downloaded pictures are kept between restarts
 if os.path.exists(cache_dir):
-    shutil.rmtree(cache_dir)
+    for entry in os.scandir(cache_dir):
+        if entry.path == image_cache_dir:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+SharedTransport().configure(max_connections=int(env_vars.get("HTTP_MAX_CONNECTIONS") or 100),
+                            max_keepalive_connections=int(env_vars.get("HTTP_KEEPALIVE_CONNECTIONS") or 40),
+                            keepalive_expiry=float(env_vars.get("HTTP_KEEPALIVE_EXPIRY") or 30),
+                            max_host_connections=int(env_vars.get("HTTP_HOST_CONNECTIONS") or 6),
+                            http2=env_vars.get("HTTP2", "1") == "1")
+ImageCache(image_cache_dir,
+           max_size=int(env_vars.get("IMAGE_CACHE_SIZE") or 1024) * 1024 * 1024,
+           max_age=int(env_vars.get("IMAGE_CACHE_DAYS") or 0) * 24 * 60 * 60)
+ConversionPool().configure(workers=int(env_vars.get("CONVERSION_WORKERS") or 0),
+                           timeout=float(env_vars.get("CONVERSION_TIMEOUT") or 300),
+                           preload=['img2pdf.core', 'img2pdf.normalize'])
 with open("tools/help_message.txt", "r") as f:
     help_msg = f.read()
 
 
+class ChapterBuildError(Exception):
+    # The files of a chapter could not be built, as opposed to not being delivered to a user
+    pass
+
+
 class OutputOptions(enum.IntEnum):
     PDF = 1
     CBZ = 2
@@ -126,6 +163,19 @@ bot = Client('bot',
              max_concurrent_transmissions=3)
 
 pdf_queue = AQueue()
+if env_vars.get("DURABLE_QUEUE") == "1":
+    # Chapters waiting to be sent are kept in the database and sent after a restart
+    pdf_queue = DurableQueue(pdf_queue, {client.name: client for client in plugins.values()})
+chapter_builds = SingleFlight()
+prefetcher = Prefetcher(pdf_queue.qsize, max_bytes=int(env_vars.get("PREFETCH_SIZE") or 0) * 1024 * 1024,
+                        workers_busy=lambda: chapter_workers.busy >= chapter_workers.active)
+prefetch_chapters = int(env_vars.get("PREFETCH_CHAPTERS") or 0)
+thumbnails = ThumbnailCache()
+# Telegram lets bots send about 30 messages per second
+broadcast_rate = float(env_vars.get("BROADCAST_RATE") or 20)
+broadcast_limiter = RateLimiter(rate=broadcast_rate, burst=int(broadcast_rate), min_rate=1, max_rate=broadcast_rate)
+# Builds of a broadcast chapter tried before giving up, waiting a minute more after each failure
+broadcast_build_attempts = 3
 
 if dbname:
     DB(dbname)
@@ -193,6 +243,43 @@ async def on_queue(client: Client, message: Message):
     await message.reply(f'Queue size: {pdf_queue.qsize()}')
 
 
+@bot.on_message(filters=filters.command(['stats']))
+async def on_stats(client: Client, message: Message):
+    pool = SharedTransport().stats()
+    lines = [
+        f'Queue size: {pdf_queue.qsize()} '
+        f'({", ".join(f"{lane.value} {pdf_queue.qsize(lane)}" for lane in Lane)})',
+        '',
+        f'HTTP requests: {pool["requests"]}',
+        f'HTTP connections: {pool["connections"]}/{pool["max_connections"]} '
+        f'({pool["idle_connections"]} idle, {pool["http2_connections"]} HTTP/2)',
+    ]
+    lines += [f'`{host}`: {n} active, {pool["waiting"].get(host, 0)} waiting' for host, n in pool['active'].items()]
+    prefetch = prefetcher.stats()
+    lines += [
+        '',
+        f'Prefetched: {prefetch["prefetched_bytes"] // (1024 * 1024)}/{prefetch["max_bytes"] // (1024 * 1024)} MB, '
+        f'{prefetch["hits"]} hits, {prefetch["cancelled"]} cancelled',
+    ]
+    conversions = ConversionPool().stats()
+    lines += [
+        f'Conversions: {conversions["running"]} running, {conversions["pending"]} pending on '
+        f'{conversions["workers"]} processes, {conversions["completed"]} done, {conversions["failed"]} failed, '
+        f'{conversions["timeouts"]} timed out',
+    ]
+    workers = chapter_workers.stats()
+    lines += [
+        '',
+        f'Workers: {workers["workers"]} ({workers["busy"]} busy, {workers["min_workers"]} to '
+        f'{workers["max_workers"]}), {workers["uploads"]} uploads, CPU {workers["cpu_share"]:.0%}, '
+        f'scaled up {workers["scale_ups"]} and down {workers["scale_downs"]} times',
+    ]
+    if decision := workers["last_decision"]:
+        ago = time.monotonic() - decision["time"]
+        lines.append(f'Last scaled {decision["action"]} to {decision["workers"]} {ago:.0f}s ago: {decision["reason"]}')
+    await message.reply('\n'.join(lines))
+
+
 @bot.on_message(filters=filters.command(['refresh']))
 async def on_refresh(client: Client, message: Message):
     text = message.reply_to_message.text or message.reply_to_message.caption
@@ -368,6 +455,7 @@ async def manga_click(client, callback: CallbackQuery, pagination: Pagination =
     for result in results:
         chapters[result.unique()] = result
         full_pages[full_page_key].append(result.unique())
+        chapter_pages[result.unique()] = full_page_key
 
     db = DB()
     subs = await db.get(Subscription, (pagination.manga.url, str(callback.from_user.id)))
@@ -398,7 +486,8 @@ async def manga_click(client, callback: CallbackQuery, pagination: Pagination =
             pagination.message = message
         except pyrogram.errors.BadRequest as e:
             file_name = f'pictures/{pagination.manga.unique()}.jpg'
-            await pagination.manga.client.get_cover(pagination.manga, cache=True, file_name=file_name)
+            await pagination.manga.client.get_cover(pagination.manga, cache=True, file_name=file_name,
+                                                    req_content=False)
             message = await bot.send_photo(callback.from_user.id,
                                            f'./cache/{pagination.manga.client.name}/{file_name}',
                                            f'{pagination.manga.name}\n'
@@ -422,9 +511,115 @@ async def get_user_lock(chat_id: int):
         return locks[chat_id]
 
 
-async def chapter_click(client, data, chat_id):
-    await pdf_queue.put(chapters[data], int(chat_id))
+async def chapter_click(client, data, chat_id, prefetch=True, lane=Lane.INTERACTIVE):
+    prefetcher.requested(chapters[data])
+    await pdf_queue.put(chapters[data], int(chat_id), lane)
     logger.debug(f"Put chapter {chapters[data].name} to queue for user {chat_id} - queue size: {pdf_queue.qsize()}")
+    if prefetch and prefetch_chapters and data in chapter_pages:
+        # Chapters are listed newest first, so the ones the user will read next are the ones before this one
+        page = full_pages[chapter_pages[data]]
+        index = page.index(data)
+        prefetcher.schedule([chapters[key] for key in reversed(page[max(index - prefetch_chapters, 0):index])])
+
+
+async def build_chapter(chapter: MangaChapter, name: str, outputs: List[OutputOptions]):
+    """
+    Downloads the pictures of the chapter and adds each one to the requested files as soon as it is downloaded,
+    so building the files overlaps with downloading the rest of the chapter.
+    Returns the pictures folder, the parts of each built file (paths, or in memory files when the chapter was built in
+    memory), the thumbnail as an in memory file and the outputs that could not be built.
+    """
+    loop = asyncio.get_running_loop()
+    folder = chapter.client.chapter_folder(chapter)
+    # With a memory limit chapters are built in memory, the files are only written to disk if they grow over it
+    memory_limit = int(env_vars.get("MEMORY_BUILD_SIZE") or 0) * 1024 * 1024
+    if memory_limit:
+        pictures = chapter.client.iter_picture_data(chapter)
+    else:
+        os.makedirs(folder, exist_ok=True)
+        pictures = chapter.client.iter_pictures(chapter)
+
+    # Every page is read once and added to all the files at the same time
+    # Chapters of the same manga share their thumbnail
+    thumbnail = None if env_vars["THUMB"] else thumbnails.get(chapter.manga.url)
+    builder = ChapterBuilder(folder, name, pdf=OutputOptions.PDF in outputs, cbz=OutputOptions.CBZ in outputs,
+                             thumb=not env_vars["THUMB"] and thumbnail is None, memory_limit=memory_limit,
+                             max_part_size=int(env_vars.get("MAX_FILE_SIZE") or 0) * 1024 * 1024,
+                             title=chapter.name, series=chapter.manga.name, web=chapter.url)
+
+    # Long strips are split in pages, and pictures scaled down and converted to JPEG before being added
+    normalize = env_vars.get("NORMALIZE_PAGES") == "1" and chapter.client.normalize_pages
+    original_size = 0
+
+    try:
+        async with aclosing(pictures):
+            async for picture in pictures:
+                if memory_limit:
+                    picture_name, data = picture
+                    picture = folder / picture_name
+                else:
+                    data = await loop.run_in_executor(None, picture.read_bytes)
+                original_size += len(data)
+                pages = [(picture.name, data)]
+                try:
+                    if normalize and needs_normalizing(data):
+                        pages = await ConversionPool().run(normalize_page, picture.name, data)
+                except Exception as e:
+                    logger.warning(f'Could not normalize {picture.name} of {chapter.name} - {chapter.manga.name}: {e}')
+                for page_name, data in pages:
+                    page = None
+                    if 'pdf' in builder.builders and (page := jpeg_passthrough(data)) is None:
+                        # Pictures that have to be decoded and encoded again are converted in the conversion processes
+                        try:
+                            page = await ConversionPool().run(pdf_page, data)
+                        except Exception as e:
+                            builder.fail('pdf', e)
+                    await loop.run_in_executor(None, builder.add_page, folder / page_name, data, page)
+    except BaseException:
+        builder.abort()
+        raise
+
+    files = await loop.run_in_executor(None, builder.close)
+    files = {OutputOptions[output.upper()]: parts for output, parts in files.items()}
+    if normalize and original_size:
+        logger.info(f'Normalized {chapter.name} - {chapter.manga.name}: {original_size // 1024} KB to '
+                    f'{builder.size // 1024} KB ({100 - 100 * builder.size // original_size}% smaller)')
+
+    failed = []
+    for output, e in builder.errors.items():
+        logger.opt(exception=e).error(f'Error creating {output} for {chapter.name} - {chapter.manga.name}\n{e}')
+        failed.append(OutputOptions[output.upper()])
+
+    if builder.thumb_pages:
+        thumb = await ConversionPool().run(make_thumb, None, [BytesIO(data) for data in builder.thumb_pages])
+        thumbnail = thumb.getvalue()
+        thumbnails.put(chapter.manga.url, thumbnail)
+    thumb_path = named_buffer(thumbnail, 'thumbnail.jpg') if thumbnail else None
+
+    return folder, files, thumb_path, failed
+
+
+def needs_download(chapter_file: ChapterFile, options: int) -> bool:
+    download = not chapter_file
+    download = download or options & OutputOptions.PDF and not chapter_file.file_id
+    download = download or options & OutputOptions.CBZ and not chapter_file.cbz_id
+    return download and options & ((1 << len(OutputOptions)) - 1) != 0
+
+
+def chapter_name(chapter) -> str:
+    if env_vars["FNAME"]:
+        try:
+            try: chap_num = re.search(r"Vol (\d+(?:\.\d+)?) Chapter (\d+(?:\.\d+)?)", chapter.name).group(2)
+            except: chap_num = re.search(r"(\d+(?:\.\d+)?)", chapter.name).group(1)
+            chap_name = clean(chapter.manga.name, 20)
+            ch_name = env_vars["FNAME"]
+            ch_name = ch_name.replace("{chap_num}", str(chap_num))
+            ch_name = ch_name.replace("{chap_name}", str(chap_name))
+        except Exception as e:
+            print(e)
+    else:
+        ch_name = clean(f'{chapter.name} - {clean(chapter.manga.name, 25)}', 45)
+    return ch_name
 
 
 async def send_manga_chapter(client: Client, chapter, chat_id):
@@ -434,94 +629,105 @@ async def send_manga_chapter(client: Client, chapter, chat_id):
     options = await db.get(MangaOutput, str(chat_id))
     options = options.output if options else (1 << 30) - 1
 
+    download = needs_download(chapter_file, options)
+
+    if download:
+        # Builds of a chapter share its folder and files, whatever outputs they make, so only one runs at a time
+        if chapter_builds.running(chapter.url):
+            # Another worker is already building this chapter, wait for it and send its uploaded files, building
+            # only the outputs it didn't make
+            try:
+                await chapter_builds.wait(chapter.url)
+            except Exception as e:
+                logger.debug(f'Shared build of {chapter.name} - {chapter.manga.name} failed: {e}')
+            return await send_manga_chapter(client, chapter, chat_id)
+        return await chapter_builds.do(chapter.url, build_manga_chapter, client, chapter, chat_id, chapter_file,
+                                      options, download)
+
+    return await build_manga_chapter(client, chapter, chat_id, chapter_file, options, download)
+
+
+async def build_manga_chapter(client: Client, chapter, chat_id, chapter_file, options, download):
+    db = DB()
+
     error_caption = '\n'.join([
         f'{chapter.manga.name} - {chapter.name}',
         f'{chapter.get_url()}'
     ])
 
-    download = not chapter_file
-    download = download or options & OutputOptions.PDF and not chapter_file.file_id
-    download = download or options & OutputOptions.CBZ and not chapter_file.cbz_id
-    download = download and options & ((1 << len(OutputOptions)) - 1) != 0
+    chapter_file = chapter_file or ChapterFile(url=chapter.url)
+
+    ch_name = chapter_name(chapter)
 
     if download:
-        pictures_folder = await chapter.client.download_pictures(chapter)
+        outputs = []
+        if options & OutputOptions.PDF and not chapter_file.file_id:
+            outputs.append(OutputOptions.PDF)
+        if options & OutputOptions.CBZ and not chapter_file.cbz_id:
+            outputs.append(OutputOptions.CBZ)
+        try:
+            pictures_folder, files, thumb_path, failed = await build_chapter(chapter, ch_name, outputs)
+        except Exception as e:
+            raise ChapterBuildError(f'Could not build {chapter.manga.name} - {chapter.name}: {e}') from e
         if not chapter.pictures:
             return await client.send_message(chat_id,
                                           f'There was an error parsing this chapter or chapter is missing' +
                                           f', please check the chapter at the web\n\n{error_caption}')
+        if failed:
+            return await client.send_message(chat_id, 
+                                             text=(f'There was an error making the {failed[0].name.lower()} for this '
+                                             f'chapter. Forward this message to the bot group to report the '
+                                             f'error.\n\n{error_caption}'),
+                                            )
         if env_vars["THUMB"]:
             thumb_path = env_vars["THUMB"]
-        else:
-            thumb_path = fld2thumb(pictures_folder)
 
-    chapter_file = chapter_file or ChapterFile(url=chapter.url)
-
-    if env_vars["FNAME"]:
-        try:
-            try: chap_num = re.search(r"Vol (\d+(?:\.\d+)?) Chapter (\d+(?:\.\d+)?)", chapter.name).group(2)
-            except: chap_num = re.search(r"(\d+(?:\.\d+)?)", chapter.name).group(1)
-            chap_name = clean(chapter.manga.name, 20)
-            ch_name = env_vars["FNAME"]
-            ch_name = ch_name.replace("{chap_num}", str(chap_num))
-            ch_name = ch_name.replace("{chap_name}", str(chap_name))
-        except Exception as e:
-            print(e)
-    else:
-        ch_name = clean(f'{chapter.name} - {clean(chapter.manga.name, 25)}', 45)
-        
     success_caption = f"{ch_name}\n [Read on website]({chapter.get_url()})"
 
     media_docs = []
 
+    # Big chapters are split in several files, which are all sent together
     if options & OutputOptions.PDF:
         if chapter_file.file_id:
-            media_docs.append(InputMediaDocument(chapter_file.file_id))
+            media_docs += [InputMediaDocument(file_id) for file_id in chapter_file.pdf_ids()]
         else:
-            try:
-                pdf = await asyncio.get_running_loop().run_in_executor(None, fld2pdf, pictures_folder, ch_name)
-            except Exception as e:
-                logger.exception(f'Error creating pdf for {chapter.name} - {chapter.manga.name}\n{e}')
-                return await client.send_message(chat_id, 
-                                                 text=(f'There was an error making the pdf for this chapter. '
-                                                 f'Forward this message to the bot group to report the '
-                                                 f'error.\n\n{error_caption}'),
-                                                )
-            media_docs.append(InputMediaDocument(pdf, thumb=thumb_path))
+            media_docs += [InputMediaDocument(file, thumb=thumb_path) for file in files[OutputOptions.PDF]]
 
     if options & OutputOptions.CBZ:
         if chapter_file.cbz_id:
-            media_docs.append(InputMediaDocument(chapter_file.cbz_id))
+            media_docs += [InputMediaDocument(file_id) for file_id in chapter_file.cbz_ids()]
         else:
-            try:
-                cbz = await asyncio.get_running_loop().run_in_executor(None, fld2cbz, pictures_folder, ch_name)
-            except Exception as e:
-                logger.exception(f'Error creating cbz for {chapter.name} - {chapter.manga.name}\n{e}')
-                return await client.send_message(chat_id, 
-                                                 text=(
-                                                     f'There was an error making the cbz for this chapter. '
-                                                     f'Forward this message to the bot group to report the '
-                                                     f'error.\n\n{error_caption}'),
-                                                )
-            media_docs.append(InputMediaDocument(cbz, thumb=thumb_path))
+            media_docs += [InputMediaDocument(file, thumb=thumb_path) for file in files[OutputOptions.CBZ]]
 
     if len(media_docs) == 0:
         messages: list[Message] = await retry_on_flood(client.send_message)(chat_id, success_caption)
     else:
         media_docs[-1].caption = success_caption
-        messages: list[Message] = await retry_on_flood(client.send_media_group)(chat_id, media_docs)
+        messages: list[Message] = []
+        # Files sent by id are not uploads
+        with chapter_workers.upload() if download else nullcontext():
+            # A media group holds up to 10 files
+            for i in range(0, len(media_docs), 10):
+                messages += await retry_on_flood(client.send_media_group)(chat_id, media_docs[i:i + 10])
 
     # Save file ids
     channel = env_vars.get('CACHE_CHANNEL')
     if download and media_docs:
-        for message in [x for x in messages if x.document]:
-            if message.document.file_name.endswith('.pdf'):
-                chapter_file.file_id = message.document.file_id
-                chapter_file.file_unique_id = message.document.file_unique_id
-            elif message.document.file_name.endswith('.cbz'):
-                chapter_file.cbz_id = message.document.file_id
-                chapter_file.cbz_unique_id = message.document.file_unique_id
-            if channel:
+        documents = [x.document for x in messages if x.document]
+        pdfs = [document for document in documents if document.file_name.endswith('.pdf')]
+        cbzs = [document for document in documents if document.file_name.endswith('.cbz')]
+        if pdfs:
+            chapter_file.file_id = pdfs[0].file_id
+            chapter_file.file_unique_id = pdfs[0].file_unique_id
+            chapter_file.file_parts = json.dumps([x.file_id for x in pdfs]) if len(pdfs) > 1 else None
+            chapter_file.file_unique_parts = json.dumps([x.file_unique_id for x in pdfs]) if len(pdfs) > 1 else None
+        if cbzs:
+            chapter_file.cbz_id = cbzs[0].file_id
+            chapter_file.cbz_unique_id = cbzs[0].file_unique_id
+            chapter_file.cbz_parts = json.dumps([x.file_id for x in cbzs]) if len(cbzs) > 1 else None
+            chapter_file.cbz_unique_parts = json.dumps([x.file_unique_id for x in cbzs]) if len(cbzs) > 1 else None
+        if channel:
+            for message in [x for x in messages if x.document]:
                 try: await message.copy(channel)
                 except: pass
 
@@ -530,6 +736,83 @@ async def send_manga_chapter(client: Client, chapter, chat_id):
         await db.add(chapter_file)
 
 
+async def send_broadcast(client: Client, broadcast: Broadcast):
+    """
+    Sends a new chapter to the subscribers of its manga. Subscribers are grouped by output options: the files a
+    group needs are built and uploaded once, sending them to its first subscriber, then everyone is sent the files by
+    id at the rate Telegram allows. A failed build is tried again later, up to broadcast_build_attempts times, before
+    the groups that need it are given up.
+    """
+    db = DB()
+    chapter = broadcast.chapter
+    all_options = (1 << len(OutputOptions)) - 1
+    outputs = await db.get_outputs(broadcast.subscribers)
+    groups = dict()  # type: Dict[int, List[str]]
+    for sub in broadcast.subscribers:
+        groups.setdefault(outputs.get(sub, all_options) & all_options, []).append(sub)
+
+    caption = f"{chapter_name(chapter)}\n [Read on website]({chapter.get_url()})"
+    chapter_file = await db.get(ChapterFile, chapter.url)
+    blocked = []
+    failed_builds = 0
+    # Subscribers asking for more outputs first, their files are the ones the others need
+    for options, subs in sorted(groups.items(), reverse=True):
+        # Until the files are uploaded. When they are built but can't be delivered to the subscriber, they are built
+        # again for the next one
+        while subs and failed_builds < broadcast_build_attempts and needs_download(chapter_file, options):
+            if failed_builds:
+                await asyncio.sleep(60 * failed_builds)
+            sub = subs[0]
+            await broadcast_limiter.acquire()
+            try:
+                await send_manga_chapter(client, chapter, int(sub))
+            except BLOCKED_ERRORS:
+                blocked.append(sub)
+                subs = subs[1:]
+                continue
+            except ChapterBuildError as e:
+                failed_builds += 1
+                logger.exception(f'Error building broadcast chapter (attempt {failed_builds}): {e}')
+                continue
+            except Exception as e:
+                logger.exception(f'Error sending chapter {chapter.name} to user {sub}: {e}')
+                subs = subs[1:]
+                continue
+            subs = subs[1:]
+            chapter_file = await db.get(ChapterFile, chapter.url)
+            if needs_download(chapter_file, options):
+                # The chapter had no pictures or an output failed, the subscriber was sent the error
+                failed_builds += 1
+                logger.error(f'Could not build {chapter.manga.name} - {chapter.name} (attempt {failed_builds})')
+        if not subs:
+            continue
+        if needs_download(chapter_file, options):
+            logger.error(f'Giving up building {chapter.manga.name} - {chapter.name}, {len(subs)} more subscribers '
+                         f'are not sent it')
+            continue
+
+        media_docs = []
+        if options & OutputOptions.PDF:
+            media_docs += [InputMediaDocument(file_id) for file_id in chapter_file.pdf_ids()]
+        if options & OutputOptions.CBZ:
+            media_docs += [InputMediaDocument(file_id) for file_id in chapter_file.cbz_ids()]
+        if media_docs:
+            media_docs[-1].caption = caption
+        # A media group holds up to 10 files
+        chunks = [media_docs[i:i + 10] for i in range(0, len(media_docs), 10)]
+
+        async def send(sub: str, part: int):
+            if not chunks:
+                return await client.send_message(int(sub), caption)
+            await client.send_media_group(int(sub), chunks[part])
+
+        blocked += await fan_out(send, subs, broadcast_limiter, parts=max(len(chunks), 1))
+
+    for sub in blocked:
+        logger.info(f'User {sub} blocked the bot')
+        await remove_subscriptions(sub)
+
+
 async def pagination_click(client: Client, callback: CallbackQuery):
     pagination_id, page = map(int, callback.data.split('_'))
     pagination = paginations[pagination_id]
@@ -541,7 +824,7 @@ async def full_page_click(client: Client, callback: CallbackQuery):
     chapters_data = full_pages[callback.data]
     for chapter_data in reversed(chapters_data):
         try:
-            await chapter_click(client, chapter_data, callback.from_user.id)
+            await chapter_click(client, chapter_data, callback.from_user.id, prefetch=False, lane=Lane.BULK)
         except Exception as e:
             logger.exception(e)
 
@@ -678,6 +961,8 @@ async def update_mangas():
         logger.debug(f'Not Updated:\t{list(not_updated)}')
 
     updated = dict()
+    # Saved once the new chapters are queued, so they are not skipped if the bot stops before
+    advanced = []  # type: List[LastChapter]
 
     for url, client in url_client_dictionary.items():
         try:
@@ -688,7 +973,6 @@ async def update_mangas():
                 agen = client.iter_chapters(url, manga_name)
                 last_chapter = await anext(agen)
                 await db.add(LastChapter(url=url, chapter_url=last_chapter.url))
-                await asyncio.sleep(10)
             else:
                 last_chapter = chapters_dictionary[url]
                 new_chapters: List[MangaChapter] = []
@@ -702,31 +986,29 @@ async def update_mangas():
                         break
                 if new_chapters:
                     last_chapter.chapter_url = new_chapters[0].url
-                    await db.add(last_chapter)
+                    advanced.append(last_chapter)
                     updated[url] = list(reversed(new_chapters))
                     for chapter in new_chapters:
                         if chapter.unique() not in chapters:
                             chapters[chapter.unique()] = chapter
-                await asyncio.sleep(1)
         except BaseException as e:
             logger.exception(f'An exception occurred getting new chapters for url {url}: {e}')
 
-    blocked = set()
     for url, chapter_list in updated.items():
         for chapter in chapter_list:
             logger.debug(f'Updating {chapter.manga.name} - {chapter.name}')
-            for sub in subs_dictionary[url]:
-                if sub in blocked:
-                    continue
-                try:
-                    await pdf_queue.put(chapter, int(sub))
-                    logger.debug(f"Put chapter {chapter} to queue for user {sub} - queue size: {pdf_queue.qsize()}")
-                except pyrogram.errors.UserIsBlocked:
-                    logger.info(f'User {sub} blocked the bot')
-                    await remove_subscriptions(sub)
-                    blocked.add(sub)
-                except BaseException as e:
-                    logger.exception(f'An exception occurred sending new chapter: {e}')
+            # A single job sends the chapter to every subscriber
+            try:
+                await pdf_queue.put(Broadcast(chapter, subs_dictionary[url]), broadcast_lock(url), Lane.BACKGROUND)
+                logger.debug(f"Put chapter {chapter.name} to queue for {len(subs_dictionary[url])} subscribers "
+                             f"- queue size: {pdf_queue.qsize()}")
+            except BaseException as e:
+                logger.exception(f'An exception occurred sending new chapter: {e}')
+
+    if isinstance(pdf_queue, DurableQueue):
+        await pdf_queue.flush()
+    for last_chapter in advanced:
+        await db.add(last_chapter)
 
 
 async def manga_updater():
@@ -745,19 +1027,29 @@ async def manga_updater():
             await asyncio.sleep(wait_time)
 
 
-async def chapter_creation(worker_id: int = 0):
-    """
-    This function will always run in the background
-    It will be listening for a channel which notifies whether there is a new request in the request queue
-    :return:
-    """
-    logger.debug(f"Worker {worker_id}: Starting worker")
-    while True:
-        chapter, chat_id = await pdf_queue.get(worker_id)
-        logger.debug(f"Worker {worker_id}: Got chapter '{chapter.name}' from queue for user '{chat_id}'")
-        try:
+async def handle_chapter(item: Tuple[MangaChapter | Broadcast, int], worker_id: int):
+    chapter, chat_id = item
+    logger.debug(f"Worker {worker_id}: Got chapter '{chapter.name}' from queue for user '{chat_id}'")
+    try:
+        if isinstance(chapter, Broadcast):
+            await send_broadcast(bot, chapter)
+        else:
             await send_manga_chapter(bot, chapter, chat_id)
-        except:
-            logger.exception(f"Error sending chapter {chapter.name} to user {chat_id}")
-        finally:
-            pdf_queue.release(chat_id)
+    except:
+        logger.exception(f"Error sending chapter {chapter.name} to user {chat_id}")
+    finally:
+        pdf_queue.release(chat_id)
+
+
+def conversion_load() -> float:
+    # Conversions running or waiting for each conversion process, from 1 every process is busy
+    conversions = ConversionPool().stats()
+    return (conversions["running"] + conversions["pending"]) / conversions["workers"]
+
+
+# Workers sending the queued chapters, their number follows the load
+chapter_workers = WorkerPool(pdf_queue.get, handle_chapter, pdf_queue.ready, pdf_queue.waiting, conversion_load,
+                             min_workers=int(env_vars.get("MIN_WORKERS") or 2),
+                             max_workers=int(env_vars.get("MAX_WORKERS") or 30),
+                             # Pyrogram makes the uploads over max_concurrent_transmissions wait
+                             max_uploads=2 * bot.max_concurrent_transmissions)
@@ -16,7 +16,42 @@ env_vars = {
   # Ex : Chapter {chap_num} {chap_name} @Manhwa_Arena
   "FNAME": "",
   # Put Thumb Link 
-  "THUMB": ""
+  "THUMB": "",
+  # Maximum size in MB of the downloaded pictures kept in cache between restarts
+  "IMAGE_CACHE_SIZE": "1024",
+  # Pictures not used for this many days are removed from cache, 0 to keep them until there is no space left
+  "IMAGE_CACHE_DAYS": "7",
+  # Connections kept by the HTTP pool shared by all the websites, and seconds an idle connection is kept alive
+  "HTTP_MAX_CONNECTIONS": "100",
+  "HTTP_KEEPALIVE_CONNECTIONS": "40",
+  "HTTP_KEEPALIVE_EXPIRY": "30",
+  # Maximum simultaneous requests to the same host
+  "HTTP_HOST_CONNECTIONS": "6",
+  # Use HTTP/2 with the hosts that support it (1 or 0)
+  "HTTP2": "1",
+  # Number of following chapters whose pictures are downloaded in advance when a user requests a chapter
+  "PREFETCH_CHAPTERS": "2",
+  # Maximum size in MB of the pictures downloaded in advance and not requested yet
+  "PREFETCH_SIZE": "200",
+  # Processes converting pictures and building thumbnails, 0 for one per CPU core
+  "CONVERSION_WORKERS": "0",
+  # Seconds after which a conversion is stopped
+  "CONVERSION_TIMEOUT": "300",
+  # Build and upload from memory the chapters whose pictures add up to at most this many MB, the others are built
+  # on disk. Every worker may hold that much, 0 builds every chapter on disk
+  "MEMORY_BUILD_SIZE": "0",
+  # Split the long strips of the websites that use them in pages, scale down and convert their pictures to JPEG
+  # (1 or 0)
+  "NORMALIZE_PAGES": "1",
+  # Files bigger than this many MB are split in several parts, Telegram doesn't accept uploads over 2000 MB
+  "MAX_FILE_SIZE": "2000",
+  # Keep the chapters waiting to be sent in the database, so they are still sent if the bot restarts (1 or 0)
+  "DURABLE_QUEUE": "0",
+  # Messages per second sent when broadcasting a new chapter to the subscribers of a manga
+  "BROADCAST_RATE": "20",
+  # Bounds of the number of chapters built and sent at the same time, it follows the load between them
+  "MIN_WORKERS": "2",
+  "MAX_WORKERS": "30"
 }
 
 dbname = env_vars.get('DATABASE_URL_PRIMARY') or env_vars.get('DATABASE_URL') or 'sqlite:///test.db'
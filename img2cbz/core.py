@@ -1,21 +1,122 @@
+import os
 import re
+import shutil
+import time
 import zipfile
+from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import Dict, List
+from xml.etree import ElementTree
+
+# Pictures are already compressed, deflating them costs CPU to save a fraction of a percent
+# (see benchmarks/cbz_compression.py to measure it on real chapters)
+COMPRESSION = {
+    '.jpg': zipfile.ZIP_STORED,
+    '.jpeg': zipfile.ZIP_STORED,
+    '.png': zipfile.ZIP_STORED,
+    '.webp': zipfile.ZIP_STORED,
+    '.xml': zipfile.ZIP_DEFLATED,
+}
+DEFAULT_COMPRESSION = zipfile.ZIP_DEFLATED
 
 
 def fld2cbz(folder: Path, name: str):
     cbz = folder / f'{name}.cbz'
-    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)', file.name)]
+    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)$', file.name)]
     files.sort(key=lambda x: x.name)
-    img2cbz(files, cbz)
+    img2cbz(files, cbz, title=name)
     return cbz
 
 
-def img2cbz(files: List[Path], out: Path):
-    zip_file = zipfile.ZipFile(out, 'w')  # parameter "out" must be a .zip file
+def compress_type(name: str, compression: Dict[str, int] = None) -> int:
+    compression = COMPRESSION if compression is None else compression
+    return compression.get(Path(name).suffix.lower(), DEFAULT_COMPRESSION)
 
-    for image_file in files:
-        zip_file.write(image_file, compress_type=zipfile.ZIP_DEFLATED)
 
-    zip_file.close()
+def comic_info(title: str = None, series: str = None, web: str = None, pages: int = 0) -> bytes:
+    root = ElementTree.Element('ComicInfo', {'xmlns:xsd': 'http://www.w3.org/2001/XMLSchema',
+                                             'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance'})
+    for tag, value in (('Title', title), ('Series', series), ('Web', web), ('PageCount', pages)):
+        if value:
+            ElementTree.SubElement(root, tag).text = str(value)
+    if pages:
+        pages_element = ElementTree.SubElement(root, 'Pages')
+        for index in range(pages):
+            attributes = {'Image': str(index)}
+            if index == 0:
+                attributes['Type'] = 'FrontCover'
+            ElementTree.SubElement(pages_element, 'Page', attributes)
+    return ElementTree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+class CbzBuilder:
+    """
+    Builds a cbz one page at a time, so pages can be added as soon as they are available.
+    Pages are streamed into the archive, stored as they are or deflated depending on their format, and a
+    ComicInfo.xml describing the chapter is written when the cbz is closed.
+    With in_memory the cbz is not written to `out` but returned as an in memory file with the same name.
+    """
+
+    def __init__(self, out: Path, title: str = None, series: str = None, web: str = None,
+                 compression: Dict[str, int] = None, in_memory: bool = False):
+        self.out = out
+        self.title = title
+        self.series = series
+        self.web = web
+        self.compression = compression
+        self.pages = 0
+        self.buffer = BytesIO() if in_memory else None
+        self.zip_file = zipfile.ZipFile(self.buffer or out, 'w')  # parameter "out" must be a .zip file
+
+    def add_page(self, image_file: Path, data: bytes = None):
+        """
+        Adds the picture as a new page. `data` is the content of image_file when it was already read.
+        """
+        if data is not None:
+            info = zipfile.ZipInfo(image_file.name, time.localtime()[:6])
+            info.file_size = len(data)
+        else:
+            info = zipfile.ZipInfo.from_file(image_file, image_file.name)
+        info.compress_type = compress_type(image_file.name, self.compression)
+        with self.zip_file.open(info, 'w') as dest:
+            if data is not None:
+                dest.write(data)
+            else:
+                with open(image_file, 'rb') as src:
+                    shutil.copyfileobj(src, dest, 1024 * 1024)
+        self.pages += 1
+
+    def to_disk(self):
+        """
+        Moves a cbz being built in memory to `out`, the next pages are appended to the file.
+        """
+        if self.buffer is None:
+            return
+        self.zip_file.close()
+        os.makedirs(self.out.parent, exist_ok=True)
+        self.out.write_bytes(self.buffer.getbuffer())
+        self.buffer = None
+        self.zip_file = zipfile.ZipFile(self.out, 'a')
+
+    def close(self) -> Path | BytesIO:
+        self.zip_file.writestr('ComicInfo.xml', comic_info(self.title, self.series, self.web, self.pages),
+                               compress_type=compress_type('ComicInfo.xml', self.compression))
+        self.zip_file.close()
+        if self.buffer is not None:
+            self.buffer.name = self.out.name
+            self.buffer.seek(0)
+            return self.buffer
+        return self.out
+
+    def abort(self):
+        self.zip_file.close()
+        if self.buffer is None:
+            self.out.unlink(missing_ok=True)
+        self.buffer = None
+
+
+def img2cbz(files: List[Path], out: Path, **kwargs):
+    cbz = CbzBuilder(out, **kwargs)
+    for image_file in files:
+        cbz.add_page(image_file)
+    cbz.close()
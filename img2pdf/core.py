@@ -1,16 +1,20 @@
+import math
 import os
 from io import BytesIO
-from typing import List, BinaryIO
+from typing import Dict, List, BinaryIO
 from pathlib import Path
-from fpdf import FPDF
 import re
 
 from PIL import Image
 
+from img2cbz.core import CbzBuilder
+from .img_size import get_jpeg_frame, get_image_metadata, get_image_metadata_from_bytesio, UnknownImageFormat
+from .writer import PdfWriter
+
 
 def fld2pdf(folder: Path, out: str):
     
-    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)', file.name)]
+    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)$', file.name)]
     files.sort(key=lambda x: x.name)
     pdf = folder / f'{out}.pdf'
     img2pdf(files, pdf)
@@ -42,50 +46,290 @@ def pil_image(path: Path) -> (BytesIO, int, int):
     return membuf, width, height
 
 
-def unicode_to_latin1(s):
-    # Substitute the ' character
-    s = s.replace('\u2019', '\x92')
-    # Substitute the " character
-    s = s.replace('\u201d', '\x94')
-    # Substitute the - character
-    s = s.replace('\u2013', '\x96')
-    # Remove all other non-latin1 characters
-    s = s.encode('latin1', 'replace').decode('latin1')
-    return s
+# Baseline, extended and progressive frames can be embedded as they are with DCTDecode
+JPEG_PASSTHROUGH_FRAMES = {0xC0, 0xC1, 0xC2}
+JPEG_COLOR_SPACES = {1: 'DeviceGray', 3: 'DeviceRGB'}
+
+
+def jpeg_passthrough(data: bytes) -> (bytes, int, int, str):
+    """
+    Returns the content, size and color space of a JPEG that can be embedded in a pdf without being re-encoded,
+    or None when it has to be converted first (other formats, CMYK, 12 bits...).
+    """
+    try:
+        frame = get_jpeg_frame(data)
+    except UnknownImageFormat:
+        return None
+    color_space = JPEG_COLOR_SPACES.get(frame.components)
+    if frame.marker not in JPEG_PASSTHROUGH_FRAMES or frame.precision != 8 or not color_space:
+        return None
+    if not frame.width or not frame.height:
+        return None
+    return data, frame.width, frame.height, color_space
+
+
+def pdf_page(data: bytes) -> (bytes, int, int, str):
+    """
+    Returns the JPEG data, size and color space the picture is embedded with in a pdf, converting it if needed.
+    """
+    page = jpeg_passthrough(data)
+    if page is None:
+        img_bytes, width, height = pil_image(BytesIO(data))
+        page = img_bytes.getvalue(), width, height, 'DeviceRGB'
+        img_bytes.close()
+    return page
+
+
+def named_buffer(data: bytes, name: str) -> BytesIO:
+    # Uploads of in memory files take the file name from their name attribute
+    buffer = BytesIO(data)
+    buffer.name = name
+    return buffer
+
+
+class PdfBuilder:
+    """
+    Builds a pdf one page at a time, so pages can be added as soon as they are available.
+    Pages are written to `out` as they are added, only the page being added is kept in memory.
+    With in_memory the pdf is not written to `out` but returned as an in memory file with the same name.
+    """
+
+    def __init__(self, out: Path, in_memory: bool = False):
+        self.out = out
+        self.buffer = BytesIO() if in_memory else None
+        self.writer = PdfWriter(self.buffer or open(out, 'wb'))
+
+    def add_page(self, image_file: Path, page: (bytes, int, int, str) = None):
+        """
+        Adds the picture as a new page. `page` is the result of pdf_page when it was already computed elsewhere.
+        """
+        self.writer.add_page(*(page or pdf_page(image_file.read_bytes())))
+
+    def to_disk(self):
+        """
+        Moves a pdf being built in memory to `out`, the next pages are appended to the file.
+        """
+        if self.buffer is None:
+            return
+        os.makedirs(self.out.parent, exist_ok=True)
+        file = open(self.out, 'wb')
+        file.write(self.buffer.getbuffer())
+        self.writer.file = file
+        self.buffer = None
+
+    def close(self) -> Path | BytesIO:
+        self.writer.close(title=self.out.stem)
+        if self.buffer is not None:
+            self.buffer.name = self.out.name
+            self.buffer.seek(0)
+            return self.buffer
+        self.writer.file.close()
+        return self.out
+
+    def abort(self):
+        if self.buffer is None:
+            self.writer.file.close()
+            self.out.unlink(missing_ok=True)
+        self.buffer = None
 
 
 def img2pdf(files: List[Path], out: Path):
-    pdf = FPDF('P', 'pt')
+    pdf = PdfBuilder(out)
     for imageFile in files:
-        img_bytes, width, height = pil_image(imageFile)
-        
-        pdf.add_page(format=(width, height))
+        pdf.add_page(imageFile)
+    pdf.close()
 
-        pdf.image(img_bytes, 0, 0, width, height)
 
-        img_bytes.close()
+# Bytes a page adds to a file besides its picture, to predict the size of the file being built
+PDF_PAGE_SIZE = 512
+CBZ_PAGE_SIZE = 128
+# Room kept in each part for what is written when it is closed (pdf trailer, ComicInfo.xml, zip directory)
+PART_RESERVED_SIZE = 64 * 1024
+
+
+class ChapterBuilder:
+    """
+    Builds the pdf, the cbz and the thumbnail of a chapter in a single pass: every page is read once and its data
+    given to each of them, so no picture is read or decoded twice when several files are built.
+    Outputs that fail are aborted and their error kept in `errors`, the other ones are still built.
+    With memory_limit the files are built in memory and nothing is written to folder, unless the pages add up to
+    more than memory_limit bytes: then the files are moved to folder and the rest of the chapter is built on disk.
+    With max_part_size a file that would grow over max_part_size bytes is split in several parts.
+    """
+
+    def __init__(self, folder: Path, name: str, pdf: bool = True, cbz: bool = True, thumb: bool = True,
+                 memory_limit: int = 0, max_part_size: int = 0, **info):
+        self.folder = folder
+        self.name = name
+        self.info = info
+        self.memory_limit = memory_limit
+        self.in_memory = memory_limit > 0
+        self.max_part_size = max_part_size
+        self.builders = dict()  # type: Dict[str, PdfBuilder | CbzBuilder]
+        for output in [output for output, requested in (('pdf', pdf), ('cbz', cbz)) if requested]:
+            self.builders[output] = self.new_builder(output, self.folder / f'{name}.{output}')
+        self.parts = {output: [] for output in self.builders}  # type: Dict[str, List[Path | BytesIO]]
+        self.part_sizes = {output: 0 for output in self.builders}  # type: Dict[str, int]
+        self.thumb = thumb
+        self.thumb_pages = []  # type: List[bytes]
+        self.pages = 0
+        self.size = 0
+        self.errors = dict()  # type: Dict[str, Exception]
 
-    pdf.set_title(unicode_to_latin1(out.stem))
-    pdf.output(out, "F")
+    def new_builder(self, output: str, out: Path) -> PdfBuilder | CbzBuilder:
+        if output == 'pdf':
+            return PdfBuilder(out, in_memory=self.in_memory)
+        return CbzBuilder(out, in_memory=self.in_memory, **self.info)
+
+    def part_path(self, output: str, part: int) -> Path:
+        return self.folder / f'{self.name} - Part {part}.{output}'
+
+    def add_page(self, image_file: Path, data: bytes = None, page: (bytes, int, int, str) = None):
+        """
+        Adds a page to every output. `data` is the content of image_file when it was already read, and `page` the
+        result of pdf_page when it was already computed.
+        """
+        if data is None:
+            data = image_file.read_bytes()
+        for output in list(self.builders):
+            try:
+                if output == 'pdf':
+                    page = page or pdf_page(data)
+                    content, size = page, len(page[0]) + PDF_PAGE_SIZE
+                else:
+                    content, size = data, len(data) + CBZ_PAGE_SIZE + 2 * len(image_file.name)
+                if self.max_part_size and self.part_sizes[output] and \
+                        self.part_sizes[output] + size > self.max_part_size - PART_RESERVED_SIZE:
+                    self.next_part(output)
+                self.builders[output].add_page(image_file, content)
+                self.part_sizes[output] += size
+            except Exception as e:
+                self.fail(output, e)
+        # The thumbnail is made from the first page, cropped to the aspect ratio of the second one
+        if self.thumb and len(self.thumb_pages) < 2:
+            self.thumb_pages.append(data)
+        self.pages += 1
+        self.size += len(data)
+        if self.in_memory and self.size > self.memory_limit:
+            self.to_disk()
+
+    def next_part(self, output: str):
+        parts = self.parts[output]
+        file = self.builders[output].close()
+        if not parts:
+            # The first part was started with the name of the whole file
+            out = self.part_path(output, 1)
+            if isinstance(file, BytesIO):
+                file.name = out.name
+            else:
+                os.replace(file, out)
+                file = out
+        parts.append(file)
+        self.builders[output] = self.new_builder(output, self.part_path(output, len(parts) + 1))
+        self.part_sizes[output] = 0
+
+    def to_disk(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.in_memory = False
+        for output, builder in list(self.builders.items()):
+            try:
+                builder.to_disk()
+            except Exception as e:
+                self.fail(output, e)
+
+    def fail(self, output: str, e: Exception):
+        self.errors[output] = e
+        self.builders.pop(output).abort()
+        self.parts.pop(output)
+
+    def close(self) -> Dict[str, List[Path | BytesIO]]:
+        """
+        Returns the files of each output that could be built, more than one when it was split in parts.
+        """
+        for output in list(self.builders):
+            if not self.pages:
+                self.builders.pop(output).abort()
+                self.parts.pop(output)
+                continue
+            builder = self.builders.pop(output)
+            try:
+                self.parts[output].append(builder.close())
+            except Exception as e:
+                self.errors[output] = e
+                self.parts.pop(output)
+                builder.abort()
+        return self.parts
+
+    def abort(self):
+        for builder in self.builders.values():
+            builder.abort()
+        self.builders.clear()
+
+    def thumbnail(self) -> Path | BytesIO:
+        if not self.thumb_pages:
+            return None
+        return make_thumb(None if self.in_memory else self.folder, [BytesIO(data) for data in self.thumb_pages])
+
+
+def img2chapter(files: List[Path], folder: Path, name: str, **kwargs) -> (Dict[str, List[Path]], Path):
+    builder = ChapterBuilder(folder, name, **kwargs)
+    for image_file in files:
+        builder.add_page(image_file)
+    return builder.close(), builder.thumbnail()
 
 
 def fld2thumb(folder: Path):
-    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)', file.name)]
+    files = [file for file in folder.glob(r'*') if re.match(r'.*\.(jpg|png|jpeg|webp)$', file.name)]
     files.sort(key=lambda x: x.name)
     thumb_path = make_thumb(folder, files)
     return thumb_path
 
 
+def image_size(file) -> (int, int):
+    """
+    Size of a picture, given as a path or a file object, read from its header without decoding it.
+    """
+    try:
+        if isinstance(file, (str, os.PathLike)):
+            metadata = get_image_metadata(file)
+        else:
+            size = file.seek(0, os.SEEK_END)
+            file.seek(0)
+            metadata = get_image_metadata_from_bytesio(file, size)
+        if metadata.width > 0 and metadata.height > 0:
+            return metadata.width, metadata.height
+    except UnknownImageFormat:
+        pass
+    finally:
+        if not isinstance(file, (str, os.PathLike)):
+            file.seek(0)
+    with Image.open(file) as img:
+        return img.size
+
+
 def make_thumb(folder, files):
+    """
+    Makes the thumbnail from the first file, saved in folder or returned as an in memory file if folder is None.
+    """
     aspect_ratio = 0.7
     if len(files) > 1:
-        with Image.open(files[1]) as img:
-            aspect_ratio = img.width / img.height
+        width, height = image_size(files[1])
+        aspect_ratio = width / height
 
-    thumbnail = Image.open(files[0]).convert('RGB')
     tg_max_size = (300, 300)
-    thumbnail = crop_thumb(thumbnail, aspect_ratio)
+    with Image.open(files[0]) as img:
+        # JPEG pictures are decoded at the smallest scale that is still bigger than the thumbnail
+        width, height = img.size
+        scale = min(tg_max_size[0] / width, tg_max_size[1] / thumb_height(width, height, aspect_ratio))
+        img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+        thumbnail = crop_thumb(img, aspect_ratio).convert('RGB')
     thumbnail.thumbnail(tg_max_size)
+    if folder is None:
+        thumb = named_buffer(b'', 'thumbnail.jpg')
+        thumbnail.save(thumb, format='JPEG')
+        thumbnail.close()
+        thumb.seek(0)
+        return thumb
     thumb_path = folder / 'thumbnail' / f'thumbnail.jpg'
     os.makedirs(thumb_path.parent, exist_ok=True)
     thumbnail.save(thumb_path)
@@ -93,11 +337,18 @@ def make_thumb(folder, files):
     return thumb_path
 
 
-def crop_thumb(thumb: Image.Image, aspect_ratio):
-    w, h = thumb.width, thumb.height
+def thumb_height(w, h, aspect_ratio):
     if w * 2 <= h:
         b = int(h - (w / aspect_ratio))
         if b <= 0:
             b = w
+        return b
+    return h
+
+
+def crop_thumb(thumb: Image.Image, aspect_ratio):
+    w, h = thumb.width, thumb.height
+    b = thumb_height(w, h, aspect_ratio)
+    if b != h:
         thumb = thumb.crop((0, 0, w, b))
     return thumb
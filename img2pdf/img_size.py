@@ -65,6 +65,54 @@ class Image(collections.namedtuple('Image', image_fields)):
         return json.dumps(self._asdict(), indent=indent)
 
 
+JpegFrame = collections.namedtuple('JpegFrame', ['marker', 'precision', 'width', 'height', 'components'])
+
+
+def get_jpeg_frame(file_path):
+    """
+    Return the start of frame header of a JPEG file: the SOF marker (0xC0 baseline,
+    0xC1 extended, 0xC2 progressive...), sample precision, width, height and
+    number of color components. Only the headers before the frame are read.
+
+    Args:
+        file_path (str or bytes): path to an image file, or its content
+
+    Returns:
+        JpegFrame: (marker, precision, width, height, components)
+    """
+    msg = " raised while trying to decode as JPEG."
+    if isinstance(file_path, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(file_path)
+    else:
+        stream = io.open(file_path, "rb")
+    with stream as input:
+        if input.read(2) != b'\377\330':
+            raise UnknownImageFormat(FILE_UNKNOWN)
+        try:
+            while True:
+                b = input.read(1)
+                while ord(b) != 0xFF:
+                    b = input.read(1)
+                while ord(b) == 0xFF:
+                    b = input.read(1)
+                marker = ord(b)
+                if marker == 0xDA:
+                    raise UnknownImageFormat("Start of scan before frame header")
+                length = struct.unpack(">H", input.read(2))[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    precision, h, w, components = struct.unpack(">BHHB", input.read(6))
+                    return JpegFrame(marker, precision, w, h, components)
+                input.seek(length - 2, io.SEEK_CUR)
+        except UnknownImageFormat:
+            raise
+        except struct.error:
+            raise UnknownImageFormat("StructError" + msg)
+        except TypeError:
+            raise UnknownImageFormat("EOF" + msg)
+        except Exception as e:
+            raise UnknownImageFormat(e.__class__.__name__ + msg)
+
+
 def get_image_size(file_path):
     """
     Return (width, height) for a given img file content - no external
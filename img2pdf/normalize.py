@@ -0,0 +1,81 @@
+import math
+from io import BytesIO
+from typing import List, Tuple
+
+from PIL import Image
+
+# Pages wider than this are scaled down, it is already more than phones display
+MAX_WIDTH = 1080
+# Pictures taller than MAX_RATIO times their width are long strips, they are split in pages of about
+# PAGE_RATIO times their width
+MAX_RATIO = 2.5
+PAGE_RATIO = 1.6
+JPEG_QUALITY = 85
+# Fraction of a page around each cut where a plain row (the gap between two panels) is looked for to cut there
+CUT_SEARCH = 0.2
+
+
+def needs_normalizing(data: bytes, max_width: int = MAX_WIDTH, max_ratio: float = MAX_RATIO) -> bool:
+    """
+    Tells from the picture header whether normalize_page would change it.
+    """
+    with Image.open(BytesIO(data)) as img:
+        width, height = img.size
+        return img.format != 'JPEG' or width > max_width or height > width * max_ratio
+
+
+def normalize_page(name: str, data: bytes, max_width: int = MAX_WIDTH, max_ratio: float = MAX_RATIO,
+                   page_ratio: float = PAGE_RATIO, quality: int = JPEG_QUALITY) -> List[Tuple[str, bytes]]:
+    """
+    Makes a picture fit to be a page: scales it down to max_width, splits it in several pages if it is a long strip
+    and converts it to JPEG. Returns the file name and content of the resulting pages, which is the picture itself
+    when it needs no change.
+    """
+    if not needs_normalizing(data, max_width, max_ratio):
+        return [(name, data)]
+
+    with Image.open(BytesIO(data)) as original:
+        img = original.convert('RGB') if original.mode not in ('RGB', 'L') else original
+        if img.width > max_width:
+            img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+
+        cuts = [0, img.height]
+        if img.height > img.width * max_ratio:
+            cuts = split_rows(img, img.width * page_ratio)
+
+        stem = name.rsplit('.', 1)[0]
+        pages = []
+        for i, (top, bottom) in enumerate(zip(cuts, cuts[1:])):
+            page = img.crop((0, top, img.width, bottom))
+            buffer = BytesIO()
+            page.save(buffer, format='JPEG', quality=quality)
+            # Pieces keep sorting right after the pages before them
+            page_name = f'{stem}-{i:04}.jpg' if len(cuts) > 2 else f'{stem}.jpg'
+            pages.append((page_name, buffer.getvalue()))
+        return pages
+
+
+def split_rows(img: Image.Image, page_height: float) -> List[int]:
+    """
+    Rows where a strip is cut into pages of about page_height, moved to the plainest row near each cut so panels
+    and speech bubbles are not cut in half when possible.
+    """
+    count = math.ceil(img.height / page_height)
+    height = img.height / count
+    window = int(height * CUT_SEARCH)
+
+    # Rows are compared on a narrow grayscale copy, each one is 32 bytes
+    columns = 32
+    rows = img.convert('L').resize((columns, img.height), Image.BOX).tobytes()
+
+    def busyness(y: int) -> int:
+        row = rows[y * columns:(y + 1) * columns]
+        return max(row) - min(row)
+
+    cuts = [0]
+    for i in range(1, count):
+        ideal = round(height * i)
+        candidates = range(max(cuts[-1] + 1, ideal - window), min(img.height - 1, ideal + window) + 1)
+        cuts.append(min(candidates, key=lambda y: (busyness(y), abs(y - ideal)), default=ideal))
+    cuts.append(img.height)
+    return cuts
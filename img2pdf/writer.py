@@ -0,0 +1,78 @@
+import time
+from typing import BinaryIO, List
+
+
+def text_string(s: str) -> bytes:
+    # UTF-16 with a byte order mark is the only way a pdf string holds any character, hex needs no escaping
+    return b'<' + ('\ufeff' + s).encode('utf-16-be').hex().upper().encode() + b'>'
+
+
+class PdfWriter:
+    """
+    Writes a pdf made of one picture per page to `file` as pages are added: the picture and the page are written
+    as soon as the page is added, and only the offsets of the objects are kept until close() writes the page tree
+    and the cross-reference table. Memory used doesn't grow with the pages like with fpdf, which keeps the whole
+    document until it is output.
+    Pictures are JPEG data embedded as they are (DCTDecode).
+    """
+
+    # Objects written last, once all pages are known
+    PAGES = 1
+    CATALOG = 2
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.position = 0
+        self.offsets = [0, 0, 0]  # type: List[int]  # object number -> offset, 0 is the free object
+        self.pages = []  # type: List[int]
+        self.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.position += len(data)
+
+    def new_object(self) -> int:
+        self.offsets.append(0)
+        return len(self.offsets) - 1
+
+    def write_object(self, number: int, content: bytes, stream: bytes = None):
+        self.offsets[number] = self.position
+        self.write(b'%d 0 obj\n' % number + content)
+        if stream is not None:
+            self.write(b'\nstream\n')
+            self.write(stream)
+            self.write(b'\nendstream')
+        self.write(b'\nendobj\n')
+
+    def add_page(self, data: bytes, width: int, height: int, color_space: str):
+        """
+        Adds a page of the size of the picture, in points, showing the JPEG `data`.
+        """
+        image, contents, page = self.new_object(), self.new_object(), self.new_object()
+        self.write_object(image, b'<</Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /%s '
+                                 b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d>>'
+                          % (width, height, color_space.encode(), len(data)), data)
+        drawing = b'q %d 0 0 %d 0 0 cm /I0 Do Q' % (width, height)
+        self.write_object(contents, b'<</Length %d>>' % len(drawing), drawing)
+        self.write_object(page, b'<</Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R '
+                                b'/Resources <</XObject <</I0 %d 0 R>>>>>>'
+                          % (self.PAGES, width, height, contents, image))
+        self.pages.append(page)
+
+    def close(self, title: str = None):
+        """
+        Writes the document catalog and the cross-reference table, the file is left open.
+        """
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self.write_object(self.PAGES, b'<</Type /Pages /Kids [%s] /Count %d>>' % (kids, len(self.pages)))
+        self.write_object(self.CATALOG, b'<</Type /Catalog /Pages %d 0 R>>' % self.PAGES)
+        info = self.new_object()
+        created = time.strftime('D:%Y%m%d%H%M%SZ', time.gmtime()).encode()
+        self.write_object(info, b'<</CreationDate (%s)%s>>'
+                          % (created, b' /Title ' + text_string(title) if title else b''))
+
+        xref = self.position
+        self.write(b'xref\n0 %d\n0000000000 65535 f \n' % len(self.offsets))
+        self.write(b''.join(b'%010d 00000 n \n' % offset for offset in self.offsets[1:]))
+        self.write(b'trailer\n<</Size %d /Root %d 0 R /Info %d 0 R>>\nstartxref\n%d\n%%%%EOF\n'
+                   % (len(self.offsets), self.CATALOG, info, xref))
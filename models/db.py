@@ -1,8 +1,9 @@
+import json
 import os
-from typing import Type, List, TypeVar, Optional
+from typing import Type, List, TypeVar, Optional, Dict
 
 from sqlalchemy.ext.asyncio import create_async_engine
-from sqlmodel import SQLModel, Field, Session, select, delete
+from sqlmodel import SQLModel, Field, Session, select, delete, update, or_
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from tools import LanguageSingleton
@@ -19,6 +20,18 @@ class ChapterFile(SQLModel, table=True):
     cbz_id: Optional[str]
     cbz_unique_id: Optional[str]
     #telegraph_url: Optional[str]
+    # JSON lists with the file ids of every part when the files were split, file_id and cbz_id are the first ones
+    file_parts: Optional[str]
+    cbz_parts: Optional[str]
+    # Same with the file unique ids, to find the chapter from any of its parts
+    file_unique_parts: Optional[str]
+    cbz_unique_parts: Optional[str]
+
+    def pdf_ids(self) -> List[str]:
+        return json.loads(self.file_parts) if self.file_parts else [self.file_id] if self.file_id else []
+
+    def cbz_ids(self) -> List[str]:
+        return json.loads(self.cbz_parts) if self.cbz_parts else [self.cbz_id] if self.cbz_id else []
 
 
 class MangaOutput(SQLModel, table=True):
@@ -41,6 +54,24 @@ class MangaName(SQLModel, table=True):
     name: str = Field
 
 
+class QueuedChapter(SQLModel, table=True):
+    """
+    A chapter waiting to be sent to a user, kept until it was sent so it is not lost when the bot restarts.
+    Chapters broadcast to all the subscribers of a manga are a single row, whose user_id is the broadcast lock.
+    """
+    id: str = Field(primary_key=True)
+    user_id: str = Field(index=True)
+    lane: str
+    # Name of the client of the chapter, and JSON with the class and fields of the chapter and of its manga, and
+    # the subscribers of a broadcast
+    client: str
+    chapter: str
+    created: float
+    # Time until which a bot sending the chapter holds it, and times it was taken to be sent
+    leased_until: Optional[float]
+    attempts: int = 0
+
+
 class DB(metaclass=LanguageSingleton):
 
     def __init__(self, dbname: str = 'sqlite+aiosqlite:///test.db'):
@@ -80,7 +111,8 @@ class DB(metaclass=LanguageSingleton):
         async with AsyncSession(self.engine) as session:  # type: AsyncSession
             statement = select(ChapterFile).where((ChapterFile.file_unique_id == id) |
                                                   (ChapterFile.cbz_unique_id == id) |
-                                                  (ChapterFile.telegraph_url == id))
+                                                  ChapterFile.file_unique_parts.contains(f'"{id}"', autoescape=True) |
+                                                  ChapterFile.cbz_unique_parts.contains(f'"{id}"', autoescape=True))
             return (await session.exec(statement=statement)).first()
 
     async def get_subs(self, user_id: str, filters=None) -> List[MangaName]:
@@ -94,9 +126,52 @@ class DB(metaclass=LanguageSingleton):
                 statement = statement.where(MangaName.name.ilike(f'%{filter_}%') | MangaName.url.ilike(f'%{filter_}%'))
             return (await session.exec(statement=statement)).all()
 
+    async def get_outputs(self, user_ids: List[str]) -> Dict[str, int]:
+        outputs = dict()
+        async with AsyncSession(self.engine) as session:
+            # In chunks, databases limit the parameters of a query
+            for i in range(0, len(user_ids), 1000):
+                statement = select(MangaOutput).where(MangaOutput.user_id.in_(user_ids[i:i + 1000]))
+                outputs.update({row.user_id: row.output for row in (await session.exec(statement=statement)).all()})
+        return outputs
+
     async def erase_subs(self, user_id: str):
         async with AsyncSession(self.engine) as session:
             async with session.begin():
                 statement = delete(Subscription).where(Subscription.user_id == user_id)
                 await session.exec(statement=statement)
 
+    async def add_all(self, others: List[SQLModel]):
+        async with AsyncSession(self.engine) as session:  # type: AsyncSession
+            async with session.begin():
+                session.add_all(others)
+
+    async def get_queued_chapters(self, now: float) -> List[QueuedChapter]:
+        async with AsyncSession(self.engine) as session:
+            statement = (
+                select(QueuedChapter)
+                .where(or_(QueuedChapter.leased_until == None, QueuedChapter.leased_until < now))  # noqa: E711
+                .order_by(QueuedChapter.created)
+            )
+            return (await session.exec(statement=statement)).all()
+
+    async def lease_queued_chapter(self, id: str, now: float, until: float) -> bool:
+        """
+        Leases the queued chapter until `until` unless another lease on it is still valid.
+        Returns whether it was leased.
+        """
+        async with AsyncSession(self.engine) as session:
+            async with session.begin():
+                statement = (
+                    update(QueuedChapter)
+                    .where(QueuedChapter.id == id)
+                    .where(or_(QueuedChapter.leased_until == None, QueuedChapter.leased_until < now))  # noqa: E711
+                    .values(leased_until=until, attempts=QueuedChapter.attempts + 1)
+                )
+                return (await session.exec(statement=statement)).rowcount == 1
+
+    async def erase_queued_chapters(self, ids: List[str]):
+        async with AsyncSession(self.engine) as session:
+            async with session.begin():
+                statement = delete(QueuedChapter).where(QueuedChapter.id.in_(ids))
+                await session.exec(statement=statement)
@@ -1,13 +1,25 @@
+import asyncio
+import importlib.util
 import os
+import random
+import time
 from abc import abstractmethod, ABC
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import List, AsyncIterable
+from typing import List, AsyncIterable, Dict, Callable, Tuple
 
-from httpx import AsyncClient
+from httpx import AsyncClient, AsyncBaseTransport, AsyncByteStream, AsyncHTTPTransport, Limits, Response, \
+    TransportError
 from pathlib import Path
 
 from models import LastChapter
+from loguru import logger
+
 from tools import LanguageSingleton
+from tools.image_cache import ImageCache
+from tools.ratelimit import RateLimiter, CircuitBreaker, CircuitOpenError
+from tools.response_cache import ResponseCache, CachedResponse
 
 
 @dataclass
@@ -49,16 +61,234 @@ def clean(name, length=-1):
 
 
 
+class _ReleasingStream(AsyncByteStream):
+    # Response body that frees the connection slot of its host once it has been read or closed
+
+    def __init__(self, stream: AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+class SharedTransport(AsyncBaseTransport, metaclass=LanguageSingleton):
+    """
+    Connection pool shared by every MangaClient, so plugins and languages that use the same hosts reuse connections.
+    The number of simultaneous requests to each host is capped across all clients.
+    The pool is created on the first request, so it can be configured after the clients are instantiated.
+    """
+
+    def __init__(self):
+        self.max_connections = 100
+        self.max_keepalive_connections = 40
+        self.keepalive_expiry = 30.0
+        self.max_host_connections = 6
+        # HTTP/2 is negotiated with each host, and only available when the h2 package is installed
+        self.http2 = importlib.util.find_spec('h2') is not None
+        self.requests = 0
+        self._transport = None  # type: AsyncHTTPTransport
+        self._host_semaphores = dict()  # type: Dict[str, asyncio.Semaphore]
+        self._host_active = dict()  # type: Dict[str, int]
+        self._host_waiting = dict()  # type: Dict[str, int]
+
+    def configure(self, max_connections: int = None, max_keepalive_connections: int = None,
+                  keepalive_expiry: float = None, max_host_connections: int = None, http2: bool = None):
+        if self._transport:
+            logger.warning('The HTTP pool is already in use, the new settings only apply to new hosts')
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_keepalive_connections is not None:
+            self.max_keepalive_connections = max_keepalive_connections
+        if keepalive_expiry is not None:
+            self.keepalive_expiry = keepalive_expiry
+        if max_host_connections is not None:
+            self.max_host_connections = max_host_connections
+        if http2 is not None:
+            if http2 and importlib.util.find_spec('h2') is None:
+                logger.warning('HTTP/2 needs the h2 package, falling back to HTTP/1.1')
+                http2 = False
+            self.http2 = http2
+
+    @property
+    def transport(self) -> AsyncHTTPTransport:
+        if self._transport is None:
+            limits = Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive_connections,
+                            keepalive_expiry=self.keepalive_expiry)
+            self._transport = AsyncHTTPTransport(limits=limits, http2=self.http2)
+        return self._transport
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_host_connections)
+            self._host_active[host] = 0
+            self._host_waiting[host] = 0
+        semaphore = self._host_semaphores[host]
+
+        self._host_waiting[host] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._host_waiting[host] -= 1
+        self._host_active[host] += 1
+        self.requests += 1
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._host_active[host] -= 1
+                semaphore.release()
+
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        return Response(response.status_code, headers=response.headers,
+                        stream=_ReleasingStream(response.stream, release), extensions=response.extensions)
+
+    async def aclose(self):
+        # Closing one client must not close the pool used by all the others
+        pass
+
+    def stats(self) -> dict:
+        connections = getattr(self._transport, '_pool', None)
+        connections = connections.connections if connections else []
+        return {
+            'requests': self.requests,
+            'connections': len(connections),
+            'idle_connections': sum(1 for conn in connections if conn.is_idle()),
+            'http2_connections': sum(1 for conn in connections if 'HTTP/2' in conn.info()),
+            'max_connections': self.max_connections,
+            'active': {host: n for host, n in self._host_active.items() if n},
+            'waiting': {host: n for host, n in self._host_waiting.items() if n},
+        }
+
+
+class PicturesDownloadError(ValueError):
+
+    def __init__(self, manga_chapter: MangaChapter, failures: Dict[int, str]):
+        self.failures = failures
+        pages = ', '.join(f'{i}: {reason}' for i, reason in sorted(failures.items()))
+        super().__init__(f'Could not download {len(failures)} of {len(manga_chapter.pictures)} pictures of '
+                         f'{manga_chapter.manga.name} - {manga_chapter.name} ({pages})')
+
+
 class MangaClient(AsyncClient, metaclass=LanguageSingleton):
+    # Maximum number of pictures of a single chapter that are downloaded at the same time
+    pictures_concurrency = 8
+    # Size of the chunks written to disk when a response is streamed to a file
+    stream_chunk_size = 64 * 1024
+    # Seconds a page fetched with get_url is reused before asking the site again, 0 disables the response cache
+    response_cache_ttl = 60
+    # Maximum bytes of responses kept in memory by each client
+    response_cache_size = 4 * 1024 * 1024
+    # Requests per second allowed to each host of the site, the rate adapts between the min and max depending on its
+    # answers
+    requests_per_second = 10
+    min_requests_per_second = 0.5
+    max_requests_per_second = 50
+    requests_burst = 20
+    # Consecutive failures of different requests after which requests to a host fail fast, and seconds until the
+    # host is tried again
+    circuit_breaker_threshold = 5
+    circuit_breaker_timeout = 60
+    # Attempts made to download each picture, waiting a random time up to retry_backoff * 2 ** attempt in between
+    picture_retries = 5
+    retry_backoff = 0.5
+    retry_backoff_max = 30
+    retry_status_codes = {408, 425, 429, 500, 502, 503, 504}
+    # The site serves chapters as long strips, which are split in pages and scaled down when building the files
+    normalize_pages = False
 
     def __init__(self, *args, name="client", **kwargs):
         if name == "client":
             raise NotImplementedError
+        kwargs.setdefault('transport', SharedTransport())
         super().__init__(*args, **kwargs)
         self.name = name
+        self.response_cache = ResponseCache(self.response_cache_size)
+        self.rate_limiters = dict()  # type: Dict[str, RateLimiter]
+        self.circuit_breakers = dict()  # type: Dict[str, CircuitBreaker]
+        # Urls whose last request failed, retrying them is not counted as a new failure
+        self._failed_urls = OrderedDict()  # type: Dict[str, None]
+        self._downloads = dict()  # type: Dict[Path, List]  # path -> [lock, users]
+
+    def host_limits(self, host: str) -> Tuple[RateLimiter, CircuitBreaker]:
+        # Pictures are often served by other hosts than the pages, one of them failing must not stop the others
+        if host not in self.rate_limiters:
+            self.rate_limiters[host] = RateLimiter(self.requests_per_second, self.requests_burst,
+                                                   self.min_requests_per_second, self.max_requests_per_second)
+            self.circuit_breakers[host] = CircuitBreaker(f'{self.name} ({host})', self.circuit_breaker_threshold,
+                                                         self.circuit_breaker_timeout)
+        return self.rate_limiters[host], self.circuit_breakers[host]
+
+    def _failed(self, url: str) -> bool:
+        # Whether the failure of url is new, a request retried until it gives up counts as a single failure
+        if url in self._failed_urls:
+            return False
+        self._failed_urls[url] = None
+        if len(self._failed_urls) > 1000:
+            self._failed_urls.popitem(last=False)
+        return True
+
+    async def send(self, request, *args, **kwargs):
+        rate_limiter, circuit_breaker = self.host_limits(request.url.host)
+        url = str(request.url)
+        circuit_breaker.check()
+        await rate_limiter.acquire()
+        try:
+            response = await super().send(request, *args, **kwargs)
+        except TransportError:
+            # The trial request of a half-open circuit always reports back
+            if self._failed(url) or circuit_breaker.state != 'closed':
+                circuit_breaker.failure()
+            raise
+        if response.status_code == 429:
+            retry_after = response.headers.get('retry-after', '')
+            rate_limiter.backoff(float(retry_after) if retry_after.isdigit() else 0)
+        elif response.status_code >= 500:
+            new = self._failed(url)
+            if new:
+                rate_limiter.backoff()
+            if new or circuit_breaker.state != 'closed':
+                circuit_breaker.failure()
+        else:
+            self._failed_urls.pop(url, None)
+            rate_limiter.success()
+            circuit_breaker.success()
+        return response
+
+    @asynccontextmanager
+    async def download_lock(self, path: Path):
+        entry = self._downloads.setdefault(path, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._downloads[path]
+
+    def retry_delay(self, attempt: int) -> float:
+        # Full jitter, so pictures that failed together don't retry together
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
 
     async def get_url(self, url, *args, file_name=None, cache=False, req_content=True, method='get', data=None,
-                      **kwargs):
+                      response_cache=True, **kwargs):
         def response():
             pass
 
@@ -66,22 +296,42 @@ class MangaClient(AsyncClient, metaclass=LanguageSingleton):
         if cache:
             path = Path(f'cache/{self.name}/{file_name}')
             os.makedirs(path.parent, exist_ok=True)
-            try:
-                with open(path, 'rb') as f:
-                    content = f.read()
-            except FileNotFoundError:
-                if method == 'get':
-                    response = await self.get(url, *args, **kwargs)
-                elif method == 'post':
-                    response = await self.post(url, data=data or {}, **kwargs)
+            loop = asyncio.get_running_loop()
+            # Downloads of the same file wait for each other, they would write to the same partial file
+            async with self.download_lock(path):
+                if path.exists():
+                    content = await loop.run_in_executor(None, path.read_bytes) if req_content else None
                 else:
-                    raise ValueError
-                if str(response.status_code).startswith('2'):
-                    content = response.content  # httpx uses .content instead of .read()
-                    with open(path, 'wb') as f:
-                        f.write(content)
+                    part = path.with_name(f'{path.name}.part')
+                    while True:
+                        if method == 'get':
+                            request = self.build_request('GET', url, *args, **kwargs)
+                        elif method == 'post':
+                            request = self.build_request('POST', url, data=data or {}, **kwargs)
+                        else:
+                            raise ValueError
+                        # Resume a previous attempt that was interrupted
+                        resuming = part.exists() and part.stat().st_size
+                        if resuming:
+                            request.headers['Range'] = f'bytes={part.stat().st_size}-'
+                        response = await self.send(request, stream=True)
+                        try:
+                            if str(response.status_code).startswith('2'):
+                                await self.stream_to_file(response, path, resume=response.status_code == 206)
+                                content = await loop.run_in_executor(None, path.read_bytes) if req_content else None
+                            else:
+                                content = await response.aread()
+                        finally:
+                            await response.aclose()
+                        if response.status_code == 416 and resuming:
+                            # The partial file doesn't match the picture anymore, it is downloaded again from the start
+                            part.unlink(missing_ok=True)
+                            continue
+                        break
         else:
-            if method == 'get':
+            if method == 'get' and response_cache and self.response_cache_ttl:
+                response = await self.cached_get(url, *args, **kwargs)
+            elif method == 'get':
                 response = await self.get(url, *args, **kwargs)
             elif method == 'post':
                 response = await self.post(url, data=data or {}, **kwargs)
@@ -93,6 +343,54 @@ class MangaClient(AsyncClient, metaclass=LanguageSingleton):
         else:
             return response
 
+    async def cached_get(self, url, *args, **kwargs):
+        """
+        GET request served from the response cache while it is fresh.
+        Once it expires the cached response is revalidated with its ETag / Last-Modified headers if it had them.
+        """
+        request = self.build_request('GET', url, *args, **kwargs)
+        key = str(request.url)
+        entry = self.response_cache.get(key)
+        if entry and entry.fresh():
+            self.response_cache.hits += 1
+            return Response(entry.status_code, headers=entry.headers, content=entry.content, request=request)
+        if entry:
+            request.headers.update(entry.validators())
+
+        response = await self.send(request)
+
+        if response.status_code == 304 and entry:
+            self.response_cache.revalidations += 1
+            entry.expires = time.monotonic() + self.response_cache_ttl
+            return Response(entry.status_code, headers=entry.headers, content=entry.content, request=request)
+        self.response_cache.misses += 1
+        if response.status_code == 200 and 'no-store' not in response.headers.get('cache-control', ''):
+            # The content is stored decoded, so the headers describing the encoding no longer apply
+            headers = [(k, v) for k, v in response.headers.multi_items()
+                       if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')]
+            self.response_cache.put(key, CachedResponse(response.status_code, headers, response.content,
+                                                        time.monotonic() + self.response_cache_ttl))
+        else:
+            self.response_cache.remove(key)
+        return response
+
+    async def stream_to_file(self, response, path: Path, resume=False):
+        """
+        Writes the body of a streamed response to path without keeping it in memory.
+        The data is written to a temporary file that is only renamed to path once it is complete,
+        so a half written file is never taken as cached. If the download is interrupted the temporary file is kept
+        and resume=True appends the rest of the body (a 206 response to a Range request) to it.
+        """
+        loop = asyncio.get_running_loop()
+        part = path.with_name(f'{path.name}.part')
+        f = await loop.run_in_executor(None, open, part, 'ab' if resume else 'wb')
+        try:
+            async for chunk in response.aiter_bytes(self.stream_chunk_size):
+                await loop.run_in_executor(None, f.write, chunk)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        await loop.run_in_executor(None, os.replace, part, path)
+
     async def set_pictures(self, manga_chapter: MangaChapter):
         requests_url = manga_chapter.url
 
@@ -109,25 +407,125 @@ class MangaClient(AsyncClient, metaclass=LanguageSingleton):
 
         return manga_chapter
 
-    async def download_pictures(self, manga_chapter: MangaChapter):
+    def chapter_folder(self, manga_chapter: MangaChapter) -> Path:
+        return Path(f'cache/{self.name}') / clean(manga_chapter.manga.name) / clean(manga_chapter.name)
+
+    async def iter_pictures(self, manga_chapter: MangaChapter, folder_name: str = None) -> AsyncIterable[Path]:
+        """
+        Downloads the pictures of the chapter concurrently and yields their paths in order, each one as soon as it
+        and all the pictures before it are on disk.
+        """
+        folder_name = folder_name or f'{clean(manga_chapter.manga.name)}/{clean(manga_chapter.name)}'
+        image_cache = ImageCache()
+        loop = asyncio.get_running_loop()
+
+        async def download_picture(i: int, picture: str, semaphore: asyncio.Semaphore, failures: Dict[int, str]):
+            file_name = f'{folder_name}/{self.picture_name(i, picture)}'
+            path = Path(f'cache/{self.name}/{file_name}')
+            if await loop.run_in_executor(None, image_cache.fetch, picture, path):
+                return path
+            req = await self.get_picture_retrying(manga_chapter, i, picture, semaphore, failures,
+                                                  file_name=file_name, cache=True)
+            if req is None:
+                return None
+            await loop.run_in_executor(None, image_cache.put, picture, path)
+            return path
+
+        async for path in self.iter_downloads(manga_chapter, download_picture):
+            yield path
+
+    async def iter_picture_data(self, manga_chapter: MangaChapter) -> AsyncIterable[Tuple[str, bytes]]:
+        """
+        Same as iter_pictures but the pictures are kept in memory instead of being written to the chapter folder.
+        Yields the file name of each picture and its content.
+        """
+        image_cache = ImageCache()
+        loop = asyncio.get_running_loop()
+
+        async def download_picture(i: int, picture: str, semaphore: asyncio.Semaphore, failures: Dict[int, str]):
+            name = self.picture_name(i, picture)
+            if path := await loop.run_in_executor(None, image_cache.get, picture):
+                try:
+                    return name, await loop.run_in_executor(None, path.read_bytes)
+                except FileNotFoundError:
+                    pass
+            # Pictures are not kept in the response cache, they would evict the pages it is meant for
+            req = await self.get_picture_retrying(manga_chapter, i, picture, semaphore, failures,
+                                                  response_cache=False)
+            if req is None:
+                return None
+            await loop.run_in_executor(None, image_cache.put_data, picture, req.content)
+            return name, req.content
+
+        async for picture in self.iter_downloads(manga_chapter, download_picture):
+            yield picture
+
+    @staticmethod
+    def picture_name(i: int, picture: str) -> str:
+        ext = picture.split('.')[-1].split('?')[0].lower()
+        return f'{format(i, "05d")}.{ext}'
+
+    async def get_picture_retrying(self, manga_chapter: MangaChapter, i: int, picture: str,
+                                   semaphore: asyncio.Semaphore, failures: Dict[int, str], **kwargs):
+        """
+        Requests the picture until it succeeds, retrying with backoff on errors that may be temporary.
+        Returns the response, or None after recording the last error in failures.
+        """
+        for attempt in range(self.picture_retries):
+            if attempt:
+                await asyncio.sleep(self.retry_delay(attempt))
+            try:
+                async with semaphore:
+                    req = await self.get_picture(manga_chapter, picture, req_content=False, **kwargs)
+            except TransportError as e:
+                failures[i] = f'{type(e).__name__}: {e}'
+                continue
+            except CircuitOpenError as e:
+                failures[i] = str(e)
+                return None
+            if str(req.status_code).startswith('2'):  # httpx uses status_code instead of status
+                failures.pop(i, None)
+                return req
+            failures[i] = f'HTTP {req.status_code}'
+            if req.status_code not in self.retry_status_codes:
+                return None
+        return None
+
+    async def iter_downloads(self, manga_chapter: MangaChapter, download_picture: Callable) -> AsyncIterable:
+        """
+        Runs download_picture for every picture of the chapter concurrently and yields the results in order, each
+        one as soon as it and all the ones before it are done. Raises PicturesDownloadError if any failed.
+        """
         if not manga_chapter.pictures:
             await self.set_pictures(manga_chapter)
 
-        folder_name = f'{clean(manga_chapter.manga.name)}/{clean(manga_chapter.name)}'
-        i = 0
-        for picture in manga_chapter.pictures:
-            ext = picture.split('.')[-1].split('?')[0].lower()
-            file_name = f'{folder_name}/{format(i, "05d")}.{ext}'
-            for _ in range(3):
-                req = await self.get_picture(manga_chapter, picture, file_name=file_name, cache=True,
-                                             req_content=False)
-                if str(req.status_code).startswith('2'):  # httpx uses status_code instead of status
+        semaphore = asyncio.Semaphore(self.pictures_concurrency)
+        failures = dict()  # type: Dict[int, str]
+
+        tasks = [asyncio.create_task(download_picture(i, picture, semaphore, failures))
+                 for i, picture in enumerate(manga_chapter.pictures)]
+        try:
+            for task in tasks:
+                result = await task
+                if result is None:
                     break
-            else:
-                raise ValueError
-            i += 1
+                yield result
+            # Pages that did download are kept in cache even when others fail, so retrying the chapter reuses them
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if failures:
+            raise PicturesDownloadError(manga_chapter, failures)
+
+    async def download_pictures(self, manga_chapter: MangaChapter, folder_name: str = None):
+        async for _ in self.iter_pictures(manga_chapter, folder_name):
+            pass
 
-        return Path(f'cache/{manga_chapter.client.name}') / folder_name
+        if folder_name:
+            return Path(f'cache/{self.name}') / folder_name
+        return self.chapter_folder(manga_chapter)
 
     async def get_picture(self, manga_chapter: MangaChapter, url, *args, **kwargs):
         return await self.get_url(url, *args, **kwargs)
@@ -17,6 +17,8 @@ class FlameComicsClient(MangaClient):
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:97.0) Gecko/20100101 Firefox/97.0'
     }
 
+    normalize_pages = True
+
     def __init__(self, *args, name="FlameComics", **kwargs):
         super().__init__(*args, name=name, headers=self.pre_headers, **kwargs)
 
@@ -20,6 +20,8 @@ class ReaperScansClient(MangaClient):
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:97.0) Gecko/20100101 Firefox/97.0'
     }
 
+    normalize_pages = True
+
     def __init__(self, *args, name="ReaperScans", **kwargs):
         super().__init__(*args, name=name, headers=self.pre_headers, **kwargs)
 
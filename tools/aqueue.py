@@ -1,44 +1,132 @@
 import asyncio
-from typing import List, Tuple, Any, Set
+import enum
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Set
+
+
+class Lane(enum.Enum):
+    # A chapter the user clicked and is waiting for
+    INTERACTIVE = 'interactive'
+    # The chapters of a full page the user asked for at once
+    BULK = 'bulk'
+    # New chapters sent to the subscribers of a manga
+    BACKGROUND = 'background'
+
+
+# Items given from each lane for every round, when all of them have items waiting
+DEFAULT_WEIGHTS = {Lane.INTERACTIVE: 8, Lane.BULK: 3, Lane.BACKGROUND: 1}
+
+
+class LaneQueue:
+    def __init__(self, weight: int):
+        self.weight = weight
+        self.current = 0
+        self.size = 0
+        self.queues = dict()  # type: Dict[int, Deque[Any]]
+        self.ready = OrderedDict()  # type: Dict[int, None]  # ring of locks that can be given an item, next first
+        self.waiting_since = None  # type: float  # since when items are ready without any being given
 
 
 class AQueue:
-    def __init__(self, maxsize=None):
-        self._queue = []  # type: List[Tuple[Any, int]]
+    """
+    Queue of items each belonging to a lock (a user), where a lock is given only one item at a time: its next item
+    is not given until release(lock) is called.
+    Every lock has its own FIFO of items and the locks that have items and are not acquired wait their turn in a
+    ready ring, so locks are served round-robin and put, get and release don't depend on the size of the queue.
+    Items are put in a lane. Lanes with items ready are served in proportion to their weight (smooth weighted
+    round-robin), except that a lane nothing was given from for max_wait seconds is served first.
+    """
+
+    def __init__(self, maxsize=None, weights: Dict[Lane, int] = None, max_wait: float = 60):
+        self.max_wait = max_wait
+        self._lanes = {lane: LaneQueue(weight) for lane, weight in (weights or DEFAULT_WEIGHTS).items()}
         self._mask = set()  # type: Set[int]
-        self._put_lock = asyncio.Lock()
+        self._size = 0
         self._get_lock = asyncio.Lock()
         self._not_empty = asyncio.Event()
+        self._waiting = set()  # type: Set[Any]  # workers in get() that were not given an item yet
 
-    async def put(self, item: Any, lock: int):
-        async with self._put_lock:
-            self._queue.append((item, lock))
-            if lock not in self._mask:
-                self._not_empty.set()
+    async def put(self, item: Any, lock: int, lane: Lane = Lane.INTERACTIVE):
+        lane = self._lanes[lane]
+        lane.queues.setdefault(lock, deque()).append(item)
+        lane.size += 1
+        self._size += 1
+        if lock not in self._mask:
+            self._make_ready(lane, lock)
 
     async def get(self, worker_id):
-        async with self._get_lock:
-            await self._not_empty.wait()
-            available = [i for i, (_, i_lock) in enumerate(self._queue) if i_lock not in self._mask]
-            item, lock = self._queue.pop(available[0])
-            self.acquire(lock)
-            available = [i for i, (_, i_lock) in enumerate(self._queue) if i_lock not in self._mask]
-            if not available:
-                self._not_empty.clear()
-            return item, lock
+        self._waiting.add(worker_id)
+        try:
+            async with self._get_lock:
+                await self._not_empty.wait()
+                # Nothing is awaited from here, a worker cancelled while waiting never loses an item
+                return self._take()
+        finally:
+            self._waiting.discard(worker_id)
+
+    def _take(self):
+        lane = self._next_lane()
+        lock, _ = lane.ready.popitem(last=False)
+        queue = lane.queues[lock]
+        item = queue.popleft()
+        if not queue:
+            del lane.queues[lock]
+        lane.size -= 1
+        self._size -= 1
+        lane.waiting_since = time.monotonic()
+        self.acquire(lock)
+        return item, lock
+
+    def _next_lane(self) -> LaneQueue:
+        ready = [lane for lane in self._lanes.values() if lane.ready]
+        now = time.monotonic()
+        starving = [lane for lane in ready if now - lane.waiting_since >= self.max_wait]
+        if starving:
+            return min(starving, key=lambda lane: lane.waiting_since)
+        total = 0
+        for lane in ready:
+            lane.current += lane.weight
+            total += lane.weight
+        lane = max(ready, key=lambda lane: lane.current)
+        lane.current -= total
+        return lane
+
+    def _make_ready(self, lane: LaneQueue, lock: int):
+        if lock not in lane.ready:
+            if not lane.ready:
+                lane.waiting_since = time.monotonic()
+            lane.ready[lock] = None
+            self._not_empty.set()
 
     def acquire(self, lock: int):
         self._mask.add(lock)
+        for lane in self._lanes.values():
+            lane.ready.pop(lock, None)
+        if not any(lane.ready for lane in self._lanes.values()):
+            self._not_empty.clear()
 
     def release(self, lock: int):
         self._mask.remove(lock)
-        for _, i_lock in self._queue:
-            if i_lock == lock:
-                self._not_empty.set()
-                break
+        for lane in self._lanes.values():
+            if lock in lane.queues:
+                # Back at the end of the ring, after the locks that were waiting
+                self._make_ready(lane, lock)
+
+    def qsize(self, lane: Lane = None):
+        return self._size if lane is None else self._lanes[lane].size
+
+    def ready(self) -> int:
+        """
+        Number of items that could be given right now, one for each lock with items that is not acquired.
+        """
+        return len(set().union(*(lane.ready for lane in self._lanes.values())))
 
-    def qsize(self):
-        return len(self._queue)
+    def waiting(self, worker_id) -> bool:
+        """
+        Whether the worker is waiting in get() and was not given an item, so cancelling it now doesn't lose one.
+        """
+        return worker_id in self._waiting
 
     def empty(self):
-        return not self._queue
+        return not self._size
@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, List
+
+import pyrogram.errors
+from loguru import logger
+
+from .ratelimit import RateLimiter
+
+# Errors meaning the user can't be sent anything anymore. PeerIdInvalid is not one of them, the bot also gets it
+# when it lost its session
+BLOCKED_ERRORS = (pyrogram.errors.UserIsBlocked, pyrogram.errors.InputUserDeactivated,
+                  pyrogram.errors.UserDeactivated)
+
+
+@dataclass
+class Broadcast:
+    """
+    A new chapter to send to every subscriber of its manga, queued as a single job.
+    """
+    chapter: Any
+    subscribers: List[str]
+
+    @property
+    def client(self):
+        return self.chapter.client
+
+    @property
+    def name(self):
+        return self.chapter.name
+
+
+def broadcast_lock(url: str) -> int:
+    # Broadcasts of the same manga run one after the other, so subscribers get its chapters in order. Below -2^48,
+    # where no Telegram chat id is, so no user shares the lock
+    return -(1 << 48) - int(hashlib.sha1(url.encode()).hexdigest()[:12], 16)
+
+
+async def fan_out(send: Callable[[str, int], Awaitable], subscribers: List[str], limiter: RateLimiter,
+                  parts: int = 1, concurrency: int = 5) -> List[str]:
+    """
+    Calls send(subscriber, part) for every part from 0 to `parts` - 1 of every subscriber, at most `concurrency`
+    subscribers at a time and at the rate allowed by `limiter`, which slows down when Telegram asks to wait. A part
+    that got a FloodWait is sent again, not the parts before it. Returns the subscribers that blocked the bot.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    blocked = []
+
+    async def deliver(subscriber: str):
+        async with semaphore:
+            part = 0
+            while part < parts:
+                await limiter.acquire()
+                try:
+                    await send(subscriber, part)
+                    limiter.success()
+                    part += 1
+                except pyrogram.errors.FloodWait as e:
+                    logger.warning(f'FloodWait broadcasting, waiting {e.value} seconds')
+                    limiter.backoff(e.value)
+                except BLOCKED_ERRORS:
+                    blocked.append(subscriber)
+                    return
+                except Exception as e:
+                    logger.exception(f'Error broadcasting to user {subscriber}: {e}')
+                    return
+
+    await asyncio.gather(*(deliver(subscriber) for subscriber in subscribers))
+    return blocked
@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Set
+
+from loguru import logger
+
+from .singleton import LanguageSingleton
+
+
+class ConversionTimeout(Exception):
+    pass
+
+
+class ConversionJob:
+    """
+    A function submitted to the conversion pool. Awaiting result() waits for it at most `timeout` seconds.
+    """
+
+    def __init__(self, pool: "ConversionPool", executor: ProcessPoolExecutor, future: Future, name: str,
+                 timeout: float):
+        self.pool = pool
+        self.executor = executor
+        self.future = future
+        self.name = name
+        self.timeout = timeout
+
+    def cancel(self):
+        """
+        Cancels the job. A job that already started is abandoned and the process running it is stopped.
+        """
+        if not self.future.cancel() and not self.future.done():
+            self.pool.abandon(self)
+
+    async def result(self) -> Any:
+        future = asyncio.wrap_future(self.future)
+        # Retrieve the exception so it is not reported as never retrieved when the job was abandoned
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            # Shielded so the timeout or a cancelled caller doesn't leave the job running unnoticed
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout or None)
+        except asyncio.TimeoutError:
+            self.pool.timeouts += 1
+            self.cancel()
+            raise ConversionTimeout(f'{self.name} did not finish in {self.timeout} seconds')
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+
+class ConversionPool(metaclass=LanguageSingleton):
+    """
+    Runs CPU bound conversions (fld2pdf, fld2cbz, fld2thumb, page transcoding...) in worker processes, so they run on
+    every core instead of competing for the GIL with the event loop.
+    Submitted functions and their arguments must be picklable, i.e. defined at module level, and workers import the
+    main module again, so it must not start anything unless it is run as __main__.
+    """
+
+    def __init__(self):
+        self.workers = os.cpu_count() or 1
+        self.timeout = 300
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.preload = []  # type: List[str]
+        self._executor = None  # type: ProcessPoolExecutor
+        self._futures = dict()  # type: Dict[ProcessPoolExecutor, Set[Future]]
+        self._abandoned = set()  # type: Set[Future]
+
+    def configure(self, workers: int = 0, timeout: float = 300, preload: List[str] = None):
+        """
+        preload: modules of the submitted functions, imported once by the fork server instead of by every worker.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.preload = preload or []
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # The pool is created when the bot already runs threads, which forked workers could inherit locked.
+            # Workers are forked from a fork server started without them instead, or spawned where there is none
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(self.preload)
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            self._futures[self._executor] = set()
+        return self._executor
+
+    def submit(self, function: Callable, *args, timeout: float = None, **kwargs) -> ConversionJob:
+        executor = self.executor
+        future = executor.submit(function, *args, **kwargs)
+        futures = self._futures[executor]
+        futures.add(future)
+        # Futures are completed by the thread of the executor, the accounting is done in the event loop that reads it
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._done, futures, f))
+        return ConversionJob(self, executor, future, function.__name__, self.timeout if timeout is None else timeout)
+
+    async def run(self, function: Callable, *args, timeout: float = None, **kwargs) -> Any:
+        return await self.submit(function, *args, timeout=timeout, **kwargs).result()
+
+    def _done(self, futures: Set[Future], future: Future):
+        futures.discard(future)
+        if future.cancelled() or future in self._abandoned:
+            self._abandoned.discard(future)
+            return
+        if future.exception():
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    def abandon(self, job: ConversionJob):
+        """
+        A worker process can't be interrupted, so new jobs go to a new pool and the old one is stopped once its
+        other jobs are done.
+        """
+        self._abandoned.add(job.future)
+        if job.executor is not self._executor:
+            return
+        logger.warning(f'Stopping conversion {job.name}, its worker pool is replaced')
+        self.recycled += 1
+        self._executor = None
+        asyncio.get_running_loop().create_task(self._retire(job.executor))
+
+    async def _retire(self, executor: ProcessPoolExecutor):
+        # Private, but the executor has no other way to stop a running job
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False)
+        while others := [f for f in self._futures[executor] if f not in self._abandoned]:
+            await asyncio.wait([asyncio.wrap_future(f) for f in others])
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        del self._futures[executor]
+
+    def shutdown(self):
+        for executor in list(self._futures):
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def stats(self) -> dict:
+        running = sum(f.running() for futures in self._futures.values() for f in futures)
+        pending = sum(len(futures) for futures in self._futures.values()) - running
+        return {'workers': self.workers, 'running': running, 'pending': pending, 'completed': self.completed,
+                'failed': self.failed, 'timeouts': self.timeouts, 'recycled': self.recycled}
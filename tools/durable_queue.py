@@ -0,0 +1,210 @@
+import asyncio
+import dataclasses
+import importlib
+import json
+import time
+import uuid
+from typing import Any, Dict, List, Set, Tuple
+
+from loguru import logger
+
+from models import DB, QueuedChapter
+from .aqueue import AQueue, Lane
+from .broadcast import Broadcast
+
+
+def class_path(cls: type) -> str:
+    return f'{cls.__module__}:{cls.__qualname__}'
+
+
+def load_class(path: str) -> type:
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def dump_chapter(chapter) -> dict:
+    # The client is stored by name, it is not serializable and chapters are given the running one when loaded
+    def fields(obj, skip):
+        return {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj) if field.name not in skip}
+
+    return {
+        'class': class_path(type(chapter)), 'fields': fields(chapter, ('client', 'manga')),
+        'manga': {'class': class_path(type(chapter.manga)), 'fields': fields(chapter.manga, ('client',))},
+    }
+
+
+def load_chapter(data: dict, client):
+    manga = load_class(data['manga']['class'])(client=client, **data['manga']['fields'])
+    return load_class(data['class'])(client=client, manga=manga, **data['fields'])
+
+
+def dump_item(item) -> str:
+    if isinstance(item, Broadcast):
+        return json.dumps({'chapter': dump_chapter(item.chapter), 'subscribers': item.subscribers})
+    return json.dumps(dump_chapter(item))
+
+
+def load_item(data: str, client):
+    data = json.loads(data)
+    if 'subscribers' in data:
+        return Broadcast(load_chapter(data['chapter'], client), data['subscribers'])
+    return load_chapter(data, client)
+
+
+@dataclasses.dataclass
+class QueuedItem:
+    id: str
+    chapter: Any
+    stored: bool
+
+
+class DurableQueue:
+    """
+    AQueue whose chapters are also written to the database until they were sent, so the chapters waiting when the
+    bot stops are sent when it starts again (recover). A chapter may be sent twice but is never lost.
+    Writes are batched: put() returns at once and the chapters put within flush_interval seconds, or batch_size
+    chapters, are inserted together. Chapters that were sent are deleted the same way.
+    A chapter taken by get() is leased for lease_time seconds, so another bot using the same database doesn't take
+    it too while it is being sent, and a chapter that was taken max_attempts times without being sent is dropped.
+    """
+
+    def __init__(self, queue: AQueue, clients: Dict[str, Any], batch_size: int = 500, flush_interval: float = 0.5,
+                 lease_time: float = 15 * 60, max_attempts: int = 3):
+        self.queue = queue
+        self.clients = clients
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self._inserts = []  # type: List[Tuple[QueuedItem, QueuedChapter]]
+        self._deletes = []  # type: List[str]
+        self._flusher = None  # type: asyncio.Task
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._leased = dict()  # type: Dict[int, QueuedItem]  # lock -> item being sent
+        self._known = set()  # type: Set[str]  # ids of the chapters in the queue or being sent
+        self._watcher = None  # type: asyncio.Task
+
+    async def put(self, item: Any, lock: int, lane: Lane = Lane.INTERACTIVE):
+        queued = QueuedItem(uuid.uuid4().hex, item, stored=False)
+        self._inserts.append((queued, QueuedChapter(id=queued.id, user_id=str(lock), lane=lane.value,
+                                                    client=item.client.name, chapter=dump_item(item),
+                                                    created=time.time())))
+        self._known.add(queued.id)
+        await self.queue.put(queued, lock, lane)
+        self._schedule_flush()
+
+    async def get(self, worker_id):
+        while True:
+            queued, lock = await self.queue.get(worker_id)
+            try:
+                if not queued.stored:
+                    await self.flush()
+                now = time.time()
+                leased = await DB().lease_queued_chapter(queued.id, now, now + self.lease_time)
+            except Exception as e:
+                # The chapter is still sent, the database being down is no reason not to
+                logger.exception(f'Could not lease queued chapter {queued.id}: {e}')
+                leased = True
+            if leased:
+                self._leased[lock] = queued
+                return queued.chapter, lock
+            # Sent or being sent by another bot
+            self._known.discard(queued.id)
+            self.queue.release(lock)
+
+    def release(self, lock: int):
+        queued = self._leased.pop(lock)
+        self._known.discard(queued.id)
+        self._deletes.append(queued.id)
+        self.queue.release(lock)
+        self._schedule_flush()
+
+    def qsize(self, lane: Lane = None):
+        return self.queue.qsize(lane)
+
+    def ready(self) -> int:
+        return self.queue.ready()
+
+    def waiting(self, worker_id) -> bool:
+        return self.queue.waiting(worker_id)
+
+    def empty(self):
+        return self.queue.empty()
+
+    def _schedule_flush(self):
+        if len(self._inserts) + len(self._deletes) >= self.batch_size:
+            self._batch_full.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+        except Exception as e:
+            logger.exception(f'Could not write the queue to the database: {e}')
+        finally:
+            self._flusher = None
+            if self._inserts or self._deletes:
+                self._schedule_flush()
+
+    async def flush(self):
+        """
+        Writes the chapters put and sent until now to the database.
+        """
+        async with self._flush_lock:
+            inserts, self._inserts = self._inserts, []
+            deletes, self._deletes = self._deletes, []
+            self._batch_full.clear()
+            try:
+                if inserts:
+                    await DB().add_all([row for _, row in inserts])
+                if deletes:
+                    await DB().erase_queued_chapters(deletes)
+            except Exception:
+                self._inserts[:0] = inserts
+                self._deletes[:0] = deletes
+                raise
+            for queued, _ in inserts:
+                queued.stored = True
+
+    async def recover(self):
+        """
+        Puts back in the queue the chapters of the database that are not in it, i.e. that were waiting when the bot
+        stopped or whose lease expired, and keeps doing it every few minutes.
+        """
+        db = DB()
+        drop = []
+        for row in await db.get_queued_chapters(time.time()):
+            if row.id in self._known:
+                continue
+            client = self.clients.get(row.client)
+            if row.attempts >= self.max_attempts or client is None:
+                reason = 'it was taken too many times' if client else f'client {row.client} is not available'
+                logger.warning(f'Dropping queued chapter {row.id} for user {row.user_id}, {reason}')
+                drop.append(row.id)
+                continue
+            try:
+                chapter = load_item(row.chapter, client)
+            except Exception as e:
+                logger.warning(f'Dropping queued chapter {row.id} for user {row.user_id}, it could not be loaded: {e}')
+                drop.append(row.id)
+                continue
+            self._known.add(row.id)
+            await self.queue.put(QueuedItem(row.id, chapter, stored=True), int(row.user_id), Lane(row.lane))
+        if drop:
+            await db.erase_queued_chapters(drop)
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(min(self.lease_time, 5 * 60))
+            try:
+                await self.recover()
+            except Exception as e:
+                logger.exception(f'Could not recover the queued chapters: {e}')
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, List
+
+from loguru import logger
+
+from .singleton import LanguageSingleton
+
+
+class ImageCache(metaclass=LanguageSingleton):
+    """
+    On disk cache of downloaded pictures that survives restarts.
+    Pictures are stored under the hash of their url, and the least recently used ones are removed when the cache
+    grows over max_size bytes or they have not been used in max_age seconds.
+    Methods do blocking file I/O, so they should be run in an executor from the event loop.
+    """
+
+    def __init__(self, folder: str = 'cache/images', max_size: int = 1024 * 1024 * 1024, max_age: int = 0):
+        self.folder = Path(folder)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.index_path = self.folder / 'index.json'
+        self.index_interval = 30
+        self._entries = OrderedDict()  # type: Dict[str, List]  # key -> [size, last access], oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        self._load()
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.folder / key[:2] / key
+
+    def get(self, url: str) -> Optional[Path]:
+        key = self.key(url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            path = self.path(key)
+            if not path.exists():
+                self._remove(key)
+                return None
+            self._entries[key][1] = time.time()
+            self._entries.move_to_end(key)
+            return path
+
+    def fetch(self, url: str, dest: Path) -> bool:
+        """
+        Places the cached picture for url at dest. Returns whether the picture was in the cache.
+        """
+        path = self.get(url)
+        if not path:
+            return False
+        os.makedirs(dest.parent, exist_ok=True)
+        try:
+            link(path, dest)
+        except FileNotFoundError:
+            # Evicted by another thread in the meantime
+            return False
+        return True
+
+    def put(self, url: str, src: Path):
+        key = self.key(url)
+        path = self.path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp = self._temporary(path)
+        try:
+            link(src, tmp)
+            os.replace(tmp, path)
+        finally:
+            # Left behind on errors, and by replace when path already was a link to the same file
+            tmp.unlink(missing_ok=True)
+        self._added(key, path)
+
+    def put_data(self, url: str, data: bytes):
+        key = self.key(url)
+        path = self.path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp = self._temporary(path)
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self._added(key, path)
+
+    @staticmethod
+    def _temporary(path: Path) -> Path:
+        # A name of its own for every call, the same url may be stored by several threads at once
+        fd, tmp = tempfile.mkstemp(prefix=f'{path.name}.', suffix='.tmp', dir=path.parent)
+        os.close(fd)
+        return Path(tmp)
+
+    def _added(self, key: str, path: Path):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries[key][0]
+            size = path.stat().st_size
+            self._entries[key] = [size, time.time()]
+            self._entries.move_to_end(key)
+            self._size += size
+            self._evict()
+            if time.time() - self._saved_at > self.index_interval:
+                self._save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self._size, 'max_size': self.max_size}
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            key, (size, last_access) = next(iter(self._entries.items()))
+            expired = self.max_age and now - last_access > self.max_age
+            if self._size <= self.max_size and not expired:
+                break
+            self._remove(key)
+
+    def _remove(self, key: str):
+        size, _ = self._entries.pop(key)
+        self._size -= size
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = self.index_path.with_name(f'{self.index_path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp, self.index_path)
+        self._saved_at = time.time()
+
+    def _load(self):
+        entries = []
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f'Image cache index is corrupted, it will be rebuilt: {e}')
+
+        known = set()
+        for key, (size, last_access) in entries:
+            if self.path(key).exists():
+                self._entries[key] = [size, last_access]
+                self._size += size
+                known.add(key)
+
+        # Pictures written after the last time the index was saved
+        if self.folder.exists():
+            orphans = []
+            for path in self.folder.glob('??/*'):
+                if path.name in known:
+                    continue
+                if path.name.endswith('.tmp'):
+                    path.unlink(missing_ok=True)
+                    continue
+                stat = path.stat()
+                orphans.append((stat.st_mtime, path.name, stat.st_size))
+            for last_access, key, size in sorted(orphans):
+                self._entries[key] = [size, last_access]
+                self._size += size
+
+        self._entries = OrderedDict(sorted(self._entries.items(), key=lambda item: item[1][1]))
+        self._evict()
+        logger.info(f'Image cache loaded with {len(self._entries)} pictures ({self._size // (1024 * 1024)} MB)')
+
+
+def link(src: Path, dest: Path):
+    if dest.exists():
+        os.remove(dest)
+    # Hard links avoid copying the picture, copy it when the file system does not support them
+    try:
+        os.link(src, dest)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -0,0 +1,114 @@
+import asyncio
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from loguru import logger
+
+
+class Prefetcher:
+    """
+    Downloads in the background the pictures of chapters a user is likely to request next, so they are already in
+    the image cache when the request arrives.
+    Prefetching only starts while the queue of requests is not backed up and a worker is free to take a request, and
+    running prefetches are cancelled as soon as that is no longer the case. The pictures prefetched and not requested yet are limited to max_bytes.
+    """
+
+    def __init__(self, backlog: Callable[[], int], max_bytes: int, workers_busy: Callable[[], bool] = None,
+                 max_backlog: int = 0, max_running: int = 1, max_pending: int = 20, expiry: int = 60 * 60):
+        self.backlog = backlog
+        self.workers_busy = workers_busy
+        self.max_bytes = max_bytes
+        self.max_backlog = max_backlog
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self.expiry = expiry
+        self.hits = 0
+        self.cancelled = 0
+        self._prefetched = OrderedDict()  # type: Dict[str, Tuple[int, float]]  # url -> (bytes, time), oldest first
+        self._pending = OrderedDict()  # type: Dict[str, object]
+        self._running = dict()  # type: Dict[str, asyncio.Task]
+        self._watcher = None  # type: asyncio.Task
+
+    def used_bytes(self) -> int:
+        now = time.monotonic()
+        while self._prefetched:
+            url, (_, prefetched_at) = next(iter(self._prefetched.items()))
+            if now - prefetched_at < self.expiry:
+                break
+            del self._prefetched[url]
+        return sum(size for size, _ in self._prefetched.values())
+
+    def requested(self, chapter):
+        """
+        Tells the prefetcher the chapter was requested, so it no longer counts against the budget.
+        """
+        self._pending.pop(chapter.url, None)
+        if self._prefetched.pop(chapter.url, None):
+            self.hits += 1
+        if task := self._running.get(chapter.url):
+            # The request will download it anyway
+            task.cancel()
+
+    def schedule(self, chapters: List):
+        for chapter in reversed(chapters):
+            if chapter.url not in self._prefetched and chapter.url not in self._running:
+                self._pending[chapter.url] = chapter
+                self._pending.move_to_end(chapter.url, last=False)
+        # Newest guesses first, old ones are dropped
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem()
+        self._start()
+
+    def _idle(self) -> bool:
+        if self.workers_busy and self.workers_busy():
+            return False
+        return self.backlog() <= self.max_backlog
+
+    def _start(self):
+        while self._pending and len(self._running) < self.max_running:
+            if not self._idle() or self.used_bytes() >= self.max_bytes:
+                break
+            url, chapter = self._pending.popitem(last=False)
+            self._running[url] = asyncio.create_task(self._prefetch(chapter))
+        if (self._running or self._pending) and self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _prefetch(self, chapter):
+        folder_name = f'prefetch/{chapter.unique()}'
+        try:
+            folder = await chapter.client.download_pictures(chapter, folder_name=folder_name)
+            size = sum(path.stat().st_size for path in folder.iterdir() if path.is_file())
+            self._prefetched[chapter.url] = (size, time.monotonic())
+            logger.debug(f'Prefetched {chapter.manga.name} - {chapter.name} ({size} bytes)')
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except Exception as e:
+            logger.debug(f'Could not prefetch {chapter.manga.name} - {chapter.name}: {e}')
+        finally:
+            # Only the image cache is kept, the chapter folder is rebuilt from it when requested
+            shutil.rmtree(Path(f'cache/{chapter.client.name}') / folder_name, ignore_errors=True)
+            del self._running[chapter.url]
+            self._start()
+
+    async def _watch(self):
+        # Starts pending prefetches once the queue is idle and cancels the running ones when it backs up
+        try:
+            while self._running or self._pending:
+                if not self._idle():
+                    for task in self._running.values():
+                        task.cancel()
+                elif self.used_bytes() >= self.max_bytes:
+                    self._pending.clear()
+                else:
+                    self._start()
+                await asyncio.sleep(1)
+        finally:
+            self._watcher = None
+
+    def stats(self) -> dict:
+        return {'prefetched_bytes': self.used_bytes(), 'max_bytes': self.max_bytes, 'running': len(self._running),
+                'pending': len(self._pending), 'hits': self.hits, 'cancelled': self.cancelled}
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Token bucket whose rate adapts to the site: it grows additively while requests succeed and is cut
+    multiplicatively when the site says it is overloaded (AIMD).
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float, max_rate: float,
+                 increase: float = 0.1, decrease: float = 0.5):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self, retry_after: float = 0):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `threshold` consecutive failures. Every `reset_timeout` seconds a single trial request is let
+    through, closing the circuit again if it succeeds.
+    """
+
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 60):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def check(self):
+        if self._opened_at is None:
+            return
+        now = time.monotonic()
+        # A trial that never reported back (e.g. it was cancelled) doesn't block new trials forever
+        trial_running = self._trial_at is not None and now - self._trial_at < self.reset_timeout
+        if now - self._opened_at < self.reset_timeout or trial_running:
+            raise CircuitOpenError(f'{self.name} is not responding, requests are paused')
+        self._trial_at = now
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self._trial_at is not None or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+            self._trial_at = None
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Tuple, Optional, Dict
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: List[Tuple[str, str]]
+    content: bytes
+    expires: float
+
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def validators(self) -> Dict[str, str]:
+        headers = dict()
+        if etag := self.header('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := self.header('last-modified'):
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    In memory LRU cache of responses bounded to max_size bytes of content.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()  # type: Dict[str, CachedResponse]
+        self._size = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        # Responses bigger than a fraction of the cache would evict everything else
+        if len(entry.content) > self.max_size // 8:
+            return
+        self.remove(key)
+        self._entries[key] = entry
+        self._size += len(entry.content)
+        while self._size > self.max_size:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= len(entry.content)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'size': self._size, 'hits': self.hits, 'misses': self.misses,
+                'revalidations': self.revalidations}
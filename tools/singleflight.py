@@ -0,0 +1,40 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time.
+    Callers can check whether a call for a key is already running and wait for its result instead of repeating it.
+    """
+
+    def __init__(self):
+        self._calls = dict()  # type: Dict[Hashable, asyncio.Future]
+
+    def running(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def wait(self, key: Hashable) -> Any:
+        # The call is shielded so a cancelled waiter doesn't cancel the call it is waiting for
+        return await asyncio.shield(self._calls[key])
+
+    async def do(self, key: Hashable, function: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        if key in self._calls:
+            return await self.wait(key)
+        future = asyncio.get_running_loop().create_future()
+        # Retrieve the exception so it is not reported as never retrieved when nobody was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await function(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
@@ -0,0 +1,33 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class ThumbnailCache:
+    """
+    Thumbnails of the mangas whose chapters were built recently, so the chapters of a manga released together reuse
+    the same thumbnail instead of making it again. Entries expire after max_age seconds.
+    """
+
+    def __init__(self, max_entries: int = 500, max_age: float = 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: Dict[str, Tuple[bytes, float]]  # key -> (thumbnail, time)
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[1] < self.max_age:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self._entries.pop(key, None)
+        self.misses += 1
+        return None
+
+    def put(self, key: str, thumbnail: bytes):
+        self._entries[key] = (thumbnail, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
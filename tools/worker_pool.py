@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Set
+
+from loguru import logger
+
+
+class WorkerPool:
+    """
+    Runs between min_workers and max_workers workers, each one taking items with get(worker_id) and handling them
+    with handle(item, worker_id). Every `interval` seconds the pool adds workers while items are ready and no
+    worker is free to take them, unless the bottleneck is not the workers: the CPU (the event loop is busy or every
+    conversion process is) or the uploads. Workers are removed when they are idle for idle_time seconds or when
+    the CPU or the uploads are saturated.
+    A removed worker is cancelled if waiting(worker_id) says it is waiting for an item without having taken one,
+    otherwise it stops once its current item is handled. Workers that are stopping still count against max_workers.
+    """
+
+    def __init__(self, get: Callable[[int], Awaitable[Any]], handle: Callable[[Any, int], Awaitable],
+                 ready: Callable[[], int], waiting: Callable[[int], bool], conversion_load: Callable[[], float],
+                 min_workers: int = 2, max_workers: int = 30, max_uploads: int = 6, interval: float = 5,
+                 idle_time: float = 60):
+        self.get = get
+        self.handle = handle
+        self.ready = ready
+        self.waiting = waiting
+        self.conversion_load = conversion_load
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.max_uploads = max_uploads
+        self.interval = interval
+        self.idle_time = idle_time
+        self.uploads = 0
+        self.cpu_share = 0.0
+        self.scale_ups = 0
+        self.scale_downs = 0
+        self.decisions = deque(maxlen=20)  # type: Deque[dict]
+        self._workers = dict()  # type: Dict[int, asyncio.Task]
+        self._idle = set()  # type: Set[int]
+        self._retiring = set()  # type: Set[int]
+        self._next_id = 1
+        self._idle_since = None  # type: float
+        self._manager = None  # type: asyncio.Task
+
+    def start(self):
+        for _ in range(self.min_workers):
+            self._add_worker()
+        self._manager = asyncio.get_event_loop().create_task(self._manage())
+
+    @contextmanager
+    def upload(self):
+        # Counts the uploads in flight
+        self.uploads += 1
+        try:
+            yield
+        finally:
+            self.uploads -= 1
+
+    @property
+    def active(self) -> int:
+        # Workers that were not removed
+        return len(self._workers) - len(self._retiring)
+
+    @property
+    def busy(self) -> int:
+        return len(self._workers) - len(self._idle)
+
+    def _add_worker(self):
+        worker_id = self._next_id
+        self._next_id += 1
+        self._idle.add(worker_id)
+        self._workers[worker_id] = asyncio.get_event_loop().create_task(self._run(worker_id))
+
+    async def _run(self, worker_id: int):
+        logger.debug(f"Worker {worker_id}: Starting worker")
+        try:
+            while worker_id not in self._retiring:
+                self._idle.add(worker_id)
+                item = await self.get(worker_id)
+                self._idle.discard(worker_id)
+                await self.handle(item, worker_id)
+        finally:
+            self._idle.discard(worker_id)
+            self._retiring.discard(worker_id)
+            del self._workers[worker_id]
+            logger.debug(f"Worker {worker_id}: Stopped worker")
+
+    def _retire(self, count: int):
+        # Idle workers first, they stop at once, busy ones would stop later
+        candidates = sorted(set(self._workers) - self._retiring, key=lambda worker_id: worker_id not in self._idle)
+        for worker_id in candidates[:count]:
+            self._retiring.add(worker_id)
+            if self.waiting(worker_id):
+                self._workers[worker_id].cancel()
+
+    async def _manage(self):
+        # Runs in the event loop thread, so its CPU time is the time the event loop was busy, not the one of the
+        # executor threads
+        cpu, wall = time.thread_time(), time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now_cpu, now_wall = time.thread_time(), time.monotonic()
+            # Share of the time the event loop used the CPU, near 1 it is the bottleneck
+            self.cpu_share = (now_cpu - cpu) / (now_wall - wall)
+            cpu, wall = now_cpu, now_wall
+            try:
+                self._scale(now_wall)
+            except Exception as e:
+                logger.exception(f'Error scaling the workers: {e}')
+
+    def _scale(self, now: float):
+        idle = len(self._idle - self._retiring)
+        waiting = self.ready() - idle
+        conversion_load = self.conversion_load()
+        saturated = None
+        if self.cpu_share >= 0.9:
+            saturated = 'event loop CPU'
+        elif conversion_load >= 1:
+            saturated = 'conversion processes'
+        elif self.uploads >= self.max_uploads:
+            saturated = 'uploads'
+
+        if waiting <= 0 and idle > 1:
+            self._idle_since = self._idle_since or now
+        else:
+            self._idle_since = None
+
+        active = self.active
+        # Workers still handling their last item run too
+        room = self.max_workers - len(self._workers)
+        if waiting > 0 and not saturated and room > 0:
+            # Grows by half at most at once and one at a time close to a bottleneck, the next round sees whether it
+            # helped
+            loaded = self.cpu_share >= 0.5 or conversion_load >= 0.5 or self.uploads >= self.max_uploads / 2
+            added = min(waiting, 1 if loaded else max(1, active // 2), room)
+            for _ in range(added):
+                self._add_worker()
+            self.scale_ups += 1
+            self._decide(now, 'up', active + added, f'{waiting} items waiting for a worker', conversion_load)
+        elif saturated and waiting > 0 and active > self.min_workers:
+            self._retire(1)
+            self.scale_downs += 1
+            self._decide(now, 'down', active - 1, f'{saturated} saturated', conversion_load)
+        elif self._idle_since and now - self._idle_since >= self.idle_time and active > self.min_workers:
+            # Keeps one idle worker so the next item doesn't wait for the next round
+            removed = min(idle - 1, active - self.min_workers)
+            self._retire(removed)
+            self.scale_downs += 1
+            self._idle_since = now
+            self._decide(now, 'down', active - removed, f'{idle} workers idle for {self.idle_time:.0f}s',
+                         conversion_load)
+
+    def _decide(self, now: float, action: str, workers: int, reason: str, conversion_load: float):
+        decision = {'time': now, 'action': action, 'workers': workers, 'reason': reason,
+                    'cpu_share': round(self.cpu_share, 3), 'conversion_load': round(conversion_load, 3),
+                    'uploads': self.uploads}
+        self.decisions.append(decision)
+        logger.info(f'Scaling chapter workers {action} to {workers}: {reason} (CPU {decision["cpu_share"]:.0%}, '
+                    f'conversions {decision["conversion_load"]:.0%}, {self.uploads} uploads)')
+
+    def stats(self) -> dict:
+        return {'workers': self.active, 'busy': self.busy, 'retiring': len(self._retiring),
+                'min_workers': self.min_workers, 'max_workers': self.max_workers, 'uploads': self.uploads,
+                'cpu_share': round(self.cpu_share, 3), 'scale_ups': self.scale_ups, 'scale_downs': self.scale_downs,
+                'last_decision': self.decisions[-1] if self.decisions else None}